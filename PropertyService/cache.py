@@ -0,0 +1,141 @@
+from abc import ABC, abstractmethod
+from typing import Any, Awaitable, Callable, Optional
+import os
+import uuid
+
+from cachetools import TLRUCache
+
+PROPERTY_CACHE_SIZE = int(os.getenv("PROPERTY_CACHE_SIZE", 10000))
+PROPERTY_CACHE_TTL = float(os.getenv("PROPERTY_CACHE_TTL", 30))
+# a user's page generation outlives the pages cached under it, it only has to expire eventually
+PROPERTY_CACHE_GENERATION_TTL = float(os.getenv("PROPERTY_CACHE_GENERATION_TTL", 24 * 3600))
+
+
+class CacheBackend(ABC):
+    """
+        Storage used by PropertyCache. The methods are async so that a backend shared between
+        uvicorn workers (e.g. Redis) can be plugged in with set_cache_backend.
+    """
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[Any]:
+        pass
+
+    @abstractmethod
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        """
+            Stores `value` for `ttl` seconds, or the backend's default TTL if None.
+        """
+        pass
+
+    @abstractmethod
+    async def delete(self, *keys: str):
+        pass
+
+    def size(self) -> Optional[int]:
+        return None
+
+
+class InMemoryCacheBackend(CacheBackend):
+    """
+        Size-bounded LRU cache whose entries expire after their own TTL, `ttl` seconds by default,
+        local to the process.
+    """
+
+    def __init__(self, maxsize: int = PROPERTY_CACHE_SIZE, ttl: float = PROPERTY_CACHE_TTL):
+        self.ttl = ttl
+        # entries are (value, ttl) pairs
+        self._cache = TLRUCache(maxsize=maxsize, ttu=lambda _key, entry, now: now + entry[1])
+
+    async def get(self, key: str) -> Optional[Any]:
+        entry = self._cache.get(key)
+        return None if entry is None else entry[0]
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        self._cache[key] = (value, self.ttl if ttl is None else ttl)
+
+    async def delete(self, *keys: str):
+        for key in keys:
+            self._cache.pop(key, None)
+
+    def size(self) -> Optional[int]:
+        return len(self._cache)
+
+
+class PropertyCache:
+    """
+        Read-through cache of the properties read by the REST endpoints. Each property and each page listed
+        for a user is cached under its own entry, whose key holds the user's current generation: any write
+        to a user's properties drops the generation, so that all of their entries are missed at once and
+        then expire on their own.
+    """
+
+    def __init__(self, backend: CacheBackend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _property_key(user_email: str, generation: str, prop_id: int) -> str:
+        return f"property:{user_email}:{generation}:{prop_id}"
+
+    @staticmethod
+    def _generation_key(user_email: str) -> str:
+        return f"generation:{user_email}"
+
+    @staticmethod
+    def _page_key(user_email: str, generation: str, page_key: str) -> str:
+        return f"properties:{user_email}:{generation}:{page_key}"
+
+    def _count(self, value):
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def _generation(self, user_email: str) -> str:
+        if (generation := await self.backend.get(self._generation_key(user_email))) is None:
+            # never reused, so that no entry cached before an invalidation can be read again
+            generation = uuid.uuid4().hex
+            await self.backend.set(self._generation_key(user_email), generation, PROPERTY_CACHE_GENERATION_TTL)
+        return generation
+
+    async def _get(self, key: str, load: Callable[[], Awaitable[Any]]) -> Any:
+        if (value := self._count(await self.backend.get(key))) is None and (value := await load()) is not None:
+            await self.backend.set(key, value)
+        return value
+
+    async def get_property(self, user_email: str, prop_id: int,
+                           load: Callable[[], Awaitable[Optional[dict]]]) -> Optional[dict]:
+        """
+            Cached property of the user, loaded with `load` on a miss, None if it doesn't exist. The generation
+            is read before loading, so that a property loaded while it is written isn't cached as current.
+        """
+        return await self._get(self._property_key(user_email, await self._generation(user_email), prop_id), load)
+
+    async def get_page(self, user_email: str, page_key: str, load: Callable[[], Awaitable[Any]]) -> Any:
+        """
+            Cached page `page_key` of the user, loaded with `load` on a miss, read as get_property.
+        """
+        return await self._get(self._page_key(user_email, await self._generation(user_email), page_key), load)
+
+    async def invalidate(self, user_email: str):
+        await self.backend.delete(self._generation_key(user_email))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "size": self.backend.size(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups > 0 else None,
+        }
+
+
+property_cache = PropertyCache(InMemoryCacheBackend())
+
+
+def set_cache_backend(backend: CacheBackend):
+    property_cache.backend = backend
@@ -0,0 +1,83 @@
+import asyncio
+import time
+import zlib
+from typing import Any, Awaitable, Callable, Optional
+
+from aio_pika.abc import AbstractIncomingMessage
+
+from PropertyService.logs import get_logger
+from PropertyService.metrics import CONSUMER_DURATION, CONSUMER_LAG
+
+logger = get_logger(__name__)
+
+
+class ShardedConsumer:
+    """
+        Queue consumer callback that processes up to `concurrency` messages at once, one per worker.
+        Messages for which `shard_key` returns the same key always go to the same worker, so they are
+        processed in the order they were delivered. Messages without a key go to the least busy worker.
+        With `decode`, each message is decoded once on delivery: `shard_key` gets the decoded message and
+        `callback` gets it as its second argument, None if it couldn't be decoded.
+        The number of messages waiting in the workers is bounded by the channel's prefetch count,
+        since messages are only acknowledged once processed.
+    """
+
+    def __init__(self, callback: Callable[..., Awaitable], concurrency: int,
+                 shard_key: Optional[Callable[[Any], Optional[str]]] = None,
+                 decode: Optional[Callable[[AbstractIncomingMessage], Any]] = None):
+        self.callback = callback
+        self.shard_key = shard_key
+        self.decode = decode
+        self.queues = [asyncio.Queue() for _ in range(max(1, concurrency))]
+        self.workers = []
+        self.duration = CONSUMER_DURATION.labels(callback.__name__)
+        self.lag = CONSUMER_LAG.labels(callback.__name__)
+
+    def start(self):
+        self.workers = [asyncio.create_task(self._work(queue)) for queue in self.queues]
+        return self
+
+    async def stop(self):
+        # the messages already delivered are processed first, they are acknowledged by now
+        await asyncio.gather(*(queue.join() for queue in self.queues))
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    async def _work(self, queue: asyncio.Queue):
+        while True:
+            incoming_message, decoded_message, delivered_at = await queue.get()
+            start = time.perf_counter()
+            self.lag.observe(start - delivered_at)
+            try:
+                if self.decode is None:
+                    await self.callback(incoming_message)
+                else:
+                    await self.callback(incoming_message, decoded_message)
+            except Exception as e:
+                logger.error("Error in consumer", extra={"consumer": self.callback.__name__, "error": str(e)})
+            finally:
+                self.duration.observe(time.perf_counter() - start)
+                queue.task_done()
+
+    def _select_queue(self, message) -> asyncio.Queue:
+        key = None
+        if self.shard_key is not None and message is not None:
+            try:
+                key = self.shard_key(message)
+            except Exception:
+                key = None
+        if key is None:
+            return min(self.queues, key=asyncio.Queue.qsize)
+        return self.queues[zlib.crc32(key.encode("utf-8")) % len(self.queues)]
+
+    async def __call__(self, incoming_message: AbstractIncomingMessage):
+        decoded_message = None
+        if self.decode is not None:
+            try:
+                decoded_message = self.decode(incoming_message)
+            except Exception:  # the callback decodes it again and handles the error
+                decoded_message = None
+        queue = self._select_queue(incoming_message if self.decode is None else decoded_message)
+        await queue.put((incoming_message, decoded_message, time.perf_counter()))
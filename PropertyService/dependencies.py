@@ -1,17 +1,59 @@
-from fastapi import Depends, Response
+import hashlib
+import os
+import time
+from threading import Lock
+
+from cachetools import TLRUCache
+from fastapi import Depends, HTTPException, Response, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from pydantic import EmailStr, BaseModel
 
 from ProjectUtils.DecoderService.decode_token import decode_token
 
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+# upper bound on how long a verified token is trusted without verifying it again, whatever its expiry
+TOKEN_CACHE_MAX_TTL = float(os.getenv("TOKEN_CACHE_MAX_TTL", 300))
+# e-mails of the users allowed to call the /admin endpoints, comma separated, none by default
+ADMIN_EMAILS = {email.strip() for email in os.getenv("ADMIN_EMAILS", "").split(",") if email.strip()}
+
 
 class UserBase(BaseModel):
     email: EmailStr
 
 
+def _verified_token_expiry(token_hash, verified_token, now):
+    user, exp = verified_token
+    return min(exp, now + TOKEN_CACHE_MAX_TTL)
+
+
+# sha256 of the bearer token -> (UserBase, token's exp claim)
+verified_tokens = TLRUCache(maxsize=TOKEN_CACHE_SIZE, ttu=_verified_token_expiry, timer=time.time)
+# get_user runs in FastAPI's threadpool and cachetools caches aren't thread safe
+verified_tokens_lock = Lock()
+
+
 def get_user(res: Response, cred: HTTPAuthorizationCredentials = Depends(HTTPBearer(auto_error=False))):
+    # FastAPI resolves this dependency once per request, even though both authRouter and get_user_email depend on it
+    if cred is None:
+        return UserBase(**decode_token(res, cred))
+
+    token_hash = hashlib.sha256(cred.credentials.encode()).hexdigest()
+    with verified_tokens_lock:
+        verified_token = verified_tokens.get(token_hash)
+    if verified_token is not None:
+        return verified_token[0]
+
     decoded_token = decode_token(res, cred)
-    return UserBase(**decoded_token)
+    user = UserBase(**decoded_token)
+    with verified_tokens_lock:
+        verified_tokens[token_hash] = (user, decoded_token.get("exp", time.time()))
+    return user
 
 def get_user_email(user: UserBase = Depends(get_user)):
     return user.email
+
+
+def get_admin_user(user: UserBase = Depends(get_user)):
+    if user.email not in ADMIN_EMAILS:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+    return user
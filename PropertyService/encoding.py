@@ -0,0 +1,92 @@
+import os
+from enum import Enum
+from typing import Any, NamedTuple
+
+import msgpack
+from aio_pika import Message
+
+from ProjectUtils.MessagingService.schemas import to_json_aoi_bytes, MessageType, from_json
+from PropertyService.logs import get_logger
+
+try:
+    import zstandard
+except ImportError:  # zstd compression is optional
+    zstandard = None
+
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+ZSTD_CONTENT_ENCODING = "zstd"
+COLUMNAR_LAYOUT = "columnar"
+# content types this service decodes, sent along with requests so that replies can use them
+ACCEPTED_CONTENT_TYPES = f"{MSGPACK_CONTENT_TYPE}, {JSON_CONTENT_TYPE}"
+
+logger = get_logger(__name__)
+
+# encoding of the bulk messages sent to the analytics service: json, msgpack or msgpack+zstd
+ANALYTICS_MESSAGE_ENCODING = os.getenv("ANALYTICS_MESSAGE_ENCODING", "json")
+if ANALYTICS_MESSAGE_ENCODING == "msgpack+zstd" and zstandard is None:
+    logger.warning("zstandard is not installed, analytics messages are sent as uncompressed msgpack")
+    ANALYTICS_MESSAGE_ENCODING = "msgpack"
+
+
+class DecodedMessage(NamedTuple):
+    message_type: MessageType
+    body: Any
+
+
+def to_columns(rows: list[dict]) -> dict[str, list]:
+    """
+        Turns a list of rows with the same keys into one list of values per key.
+    """
+    if len(rows) == 0:
+        return {}
+    return {key: [row[key] for row in rows] for key in rows[0]}
+
+
+def from_columns(columns: dict[str, list]) -> list[dict]:
+    keys = list(columns)
+    return [dict(zip(keys, values)) for values in zip(*columns.values())]
+
+
+def encode_message(message, encoding: str = ANALYTICS_MESSAGE_ENCODING, columnar: bool = False,
+                   headers: dict = None) -> Message:
+    """
+        Encodes a message from MessageFactory as JSON, or as msgpack (optionally zstd compressed) tagged
+        with its content type and encoding. With `columnar`, a body made of rows is sent as columns.
+    """
+    headers = dict(headers or {})
+    if encoding == "json":
+        encoded_message = to_json_aoi_bytes(message)
+        encoded_message.headers = {**encoded_message.headers, **headers}
+        return encoded_message
+
+    body = message.body
+    if columnar:
+        body = to_columns(body)
+        headers["x-layout"] = COLUMNAR_LAYOUT
+    message_type = message.message_type.value if isinstance(message.message_type, Enum) else message.message_type
+    payload = msgpack.packb({"message_type": message_type, "body": body}, use_bin_type=True)
+
+    content_encoding = None
+    if encoding == "msgpack+zstd":
+        payload = zstandard.ZstdCompressor().compress(payload)
+        content_encoding = ZSTD_CONTENT_ENCODING
+    return Message(body=payload, content_type=MSGPACK_CONTENT_TYPE, content_encoding=content_encoding, headers=headers)
+
+
+def decode_message(incoming_message):
+    """
+        Decodes an incoming message according to its content type, defaulting to JSON.
+    """
+    if incoming_message.content_type != MSGPACK_CONTENT_TYPE:
+        return from_json(incoming_message.body)
+
+    payload = incoming_message.body
+    if incoming_message.content_encoding == ZSTD_CONTENT_ENCODING:
+        payload = zstandard.ZstdDecompressor().decompress(payload)
+    decoded = msgpack.unpackb(payload, raw=False, strict_map_key=False)
+
+    body = decoded["body"]
+    if (incoming_message.headers or {}).get("x-layout") == COLUMNAR_LAYOUT:
+        body = from_columns(body)
+    return DecodedMessage(MessageType(decoded["message_type"]), body)
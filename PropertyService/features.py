@@ -0,0 +1,120 @@
+from pymongo import UpdateOne
+
+from PropertyService.database import collection
+
+# nested fields the materialized features are derived from
+MATERIALIZED_FEATURES_SOURCES = {"bedrooms": 1, "bathrooms": 1, "amenities": 1}
+MATERIALIZED_FEATURES = ("bedrooms", "beds", "bathrooms", "num_amenities")
+# properties whose features were never materialized, or only partly, e.g. by an update of a property stored before
+MISSING_FEATURES_FILTER = {"$or": [{f"features.{feature}": {"$exists": False}} for feature in MATERIALIZED_FEATURES]}
+# fields of a property document the features are read from
+FEATURES_PROJECTION = {"features": 1, "number_guests": 1, "location": 1, "price": 1}
+
+# the materialized features computed by MongoDB, e.g. in an update pipeline
+MATERIALIZED_FEATURES_EXPRESSION = {
+    "bedrooms": {"$size": {"$objectToArray": "$bedrooms"}},
+    "bathrooms": {"$size": {"$objectToArray": "$bathrooms"}},
+    "beds": {"$sum": {"$map": {
+        "input": {"$objectToArray": "$bedrooms"},
+        "as": "bedroom",
+        "in": {"$sum": "$$bedroom.v.beds.number_beds"}
+    }}},
+    "num_amenities": {"$size": "$amenities"},
+}
+
+
+def analytics_rows_pipeline(match: dict) -> list[dict]:
+    """
+        Aggregation pipeline returning the analytics rows of the properties matching `match`, shaped by
+        MongoDB. Properties without materialized features get them computed on the fly.
+    """
+    def feature(name):
+        return {"$ifNull": [f"$features.{name}", MATERIALIZED_FEATURES_EXPRESSION[name]]}
+
+    return [
+        {"$match": match},
+        {"$project": {
+            "_id": 0,
+            "id": {"$toString": "$_id"},
+            "bathrooms": feature("bathrooms"),
+            "bedrooms": feature("bedrooms"),
+            "beds": feature("beds"),
+            "number_of_guests": "$number_guests",
+            "num_amenities": feature("num_amenities"),
+            "location": "$location",
+            "price": "$price",
+            "services": "$services",
+            "recommended_price": {"$ifNull": ["$recommended_price", None]},
+        }},
+    ]
+
+
+def materialized_features(prop: dict) -> dict:
+    """
+        Features stored on a property document under `features`, derived from the bedrooms, bathrooms
+        and amenities present in `prop`, which may be a partial update.
+    """
+    features = {}
+    if prop.get("bedrooms") is not None:
+        features["bedrooms"] = len(prop["bedrooms"])
+        features["beds"] = sum(bed["number_beds"] for bedroom in prop["bedrooms"].values() for bed in bedroom["beds"])
+    if prop.get("bathrooms") is not None:
+        features["bathrooms"] = len(prop["bathrooms"])
+    if prop.get("amenities") is not None:
+        features["num_amenities"] = len(prop["amenities"])
+    return features
+
+
+def has_materialized_features(prop: dict) -> bool:
+    features = prop.get("features") or {}
+    return all(feature in features for feature in MATERIALIZED_FEATURES)
+
+
+def changes_features(upd_prop: dict) -> bool:
+    return any(source in upd_prop for source in MATERIALIZED_FEATURES_SOURCES)
+
+
+def materialized_features_update(upd_prop: dict) -> dict:
+    """
+        $set of the materialized features changed by a property update. Only valid for properties
+        whose features are all materialized, see has_materialized_features.
+    """
+    return {f"features.{feature}": value for feature, value in materialized_features(upd_prop).items()}
+
+
+async def ensure_materialized_features(properties: list[dict]):
+    """
+        Fills in the features of the properties read without all of them, i.e. stored before features were
+        materialized, and stores them so that the next runs don't have to.
+    """
+    missing_ids = [prop["_id"] for prop in properties if not has_materialized_features(prop)]
+    if len(missing_ids) == 0:
+        return
+    features_by_id = {
+        source["_id"]: materialized_features(source)
+        async for source in collection.find({"_id": {"$in": missing_ids}}, MATERIALIZED_FEATURES_SOURCES)
+    }
+    await collection.bulk_write(
+        [UpdateOne({"_id": prop_id}, {"$set": {"features": features}}) for prop_id, features in features_by_id.items()],
+        ordered=False
+    )
+    for prop in properties:
+        if not has_materialized_features(prop):
+            prop["features"] = features_by_id.get(prop["_id"], {})
+
+
+def feature_row(prop: dict) -> dict:
+    """
+        Features of a property document read with FEATURES_PROJECTION, as a row of plain Python values.
+    """
+    features = prop["features"]
+    return {
+        "id": str(prop["_id"]),
+        "bathrooms": features["bathrooms"],
+        "bedrooms": features["bedrooms"],
+        "beds": features["beds"],
+        "number_of_guests": prop["number_guests"],
+        "num_amenities": features["num_amenities"],
+        "location": prop["location"],
+        "price": float(prop["price"]),
+    }
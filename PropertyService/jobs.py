@@ -0,0 +1,174 @@
+import asyncio
+import functools
+import os
+import socket
+import time
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from pymongo.errors import DuplicateKeyError
+
+from PropertyService.database import job_locks, job_state
+from PropertyService.logs import get_logger
+from PropertyService.metrics import JOB_DURATION, JOB_ROWS
+
+logger = get_logger(__name__)
+
+# identifies this process as the holder of a job lease
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+# a lease expires unless renewed, so that a crashed instance doesn't block a job forever
+JOB_LOCK_TTL = timedelta(seconds=float(os.getenv("JOB_LOCK_TTL", 300)))
+# share of a job's period after its last successful run during which other runs are skipped,
+# below 1 so that the instance whose timer ran the last slot isn't skipped for a few milliseconds
+JOB_PERIOD_SLACK = float(os.getenv("JOB_PERIOD_SLACK", 0.9))
+
+
+def as_utc(moment: datetime) -> datetime:
+    # MongoDB returns naive datetimes in UTC
+    return moment if moment.tzinfo is not None else moment.replace(tzinfo=timezone.utc)
+
+
+async def acquire_lock(name: str) -> Optional[str]:
+    """
+        Takes the lease `name` unless it is held and not expired, and returns the token identifying this
+        acquisition. Leases aren't re-entrant: two runs of a job on the same instance don't share one.
+    """
+    now = datetime.now(timezone.utc)
+    token = uuid.uuid4().hex
+    try:
+        await job_locks.find_one_and_update(
+            {"_id": name, "expires_at": {"$lte": now}},
+            {"$set": {"owner": INSTANCE_ID, "token": token, "acquired_at": now, "expires_at": now + JOB_LOCK_TTL}},
+            upsert=True,
+        )
+        return token
+    except DuplicateKeyError:  # another run holds the lease
+        return None
+
+
+async def renew_lock(name: str, token: str) -> bool:
+    result = await job_locks.update_one(
+        {"_id": name, "token": token},
+        {"$set": {"expires_at": datetime.now(timezone.utc) + JOB_LOCK_TTL}}
+    )
+    return result.matched_count > 0
+
+
+async def release_lock(name: str, token: str):
+    await job_locks.delete_one({"_id": name, "token": token})
+
+
+async def keep_lock(name: str, token: str):
+    while True:
+        await asyncio.sleep(JOB_LOCK_TTL.total_seconds() / 3)
+        if not await renew_lock(name, token):
+            logger.warning("Lost the lease of a job", extra={"job": name})
+            return
+
+
+@asynccontextmanager
+async def lease(name: str):
+    """
+        Holds the lease `name`, renewed in the background, for the duration of the block.
+        Yields whether the lease could be taken, the block must skip its work otherwise.
+    """
+    if (token := await acquire_lock(name)) is None:
+        yield False
+        return
+    heartbeat = asyncio.create_task(keep_lock(name, token))
+    try:
+        yield True
+    finally:
+        heartbeat.cancel()
+        await release_lock(name, token)
+
+
+def recorded_job(name: str):
+    """
+        Logs the duration and row count (the "rows" of the job's result) of every run of a job,
+        and stores them in job_state.
+    """
+    def decorator(job):
+        @functools.wraps(job)
+        async def run(*args, **kwargs):
+            started_at = datetime.now(timezone.utc)
+            start = time.perf_counter()
+            status = "failed"
+            result = None
+            try:
+                result = await job(*args, **kwargs)
+                status = "succeeded" if result is not None else "skipped"
+                return result
+            finally:
+                duration = time.perf_counter() - start
+                rows = (result or {}).get("rows")
+                logger.info("Job run finished", extra={
+                    "job": name, "status": status, "duration_seconds": round(duration, 3), "rows": rows
+                })
+                if status != "skipped":
+                    JOB_DURATION.labels(name, status).observe(duration)
+                    JOB_ROWS.labels(name).inc(rows or 0)
+                    await job_state.update_one(
+                        {"_id": name},
+                        {"$set": {"last_run": {
+                            "instance": INSTANCE_ID,
+                            "started_at": started_at,
+                            "duration_seconds": duration,
+                            "rows": rows,
+                            "status": status,
+                        }}},
+                        upsert=True
+                    )
+        return run
+    return decorator
+
+
+def single_flight(name: str, period: timedelta):
+    """
+        Makes a job scheduled every `period` run once per period across instances: instances that can't take
+        the job's lease skip the run, and so do those whose timer fires when the job already succeeded within
+        this period, e.g. on another instance started at another time. Runs are recorded as with recorded_job.
+    """
+    def decorator(job):
+        @recorded_job(name)
+        @functools.wraps(job)
+        async def run(*args, **kwargs):
+            async with lease(name) as held:
+                if not held:
+                    logger.info("Skipping job, it is already running", extra={"job": name})
+                    return None
+                started_at = datetime.now(timezone.utc)
+                state = await job_state.find_one({"_id": name}, {"last_success": 1}) or {}
+                if state.get("last_success") is not None and \
+                        as_utc(state["last_success"]) + period * JOB_PERIOD_SLACK > started_at:
+                    logger.info("Skipping job, it already ran in this period", extra={
+                        "job": name, "last_success": state["last_success"]
+                    })
+                    return None
+                result = await job(*args, **kwargs)
+                await job_state.update_one({"_id": name}, {"$set": {"last_success": started_at}}, upsert=True)
+                return result
+        return run
+    return decorator
+
+
+async def jobs_status() -> dict:
+    """
+        Last run of every job and the instance currently running it, if any.
+    """
+    status = {}
+    async for state in job_state.find({"last_run": {"$exists": True}}, {"last_run": 1}):
+        status[state["_id"]] = {"last_run": state["last_run"], "running_on": None}
+    async for lock in job_locks.find({"expires_at": {"$gt": datetime.now(timezone.utc)}}):
+        status.setdefault(lock["_id"], {"last_run": None})["running_on"] = lock["owner"]
+    async for scan in job_state.find({"partitions": {"$exists": True}}):
+        status.setdefault(scan["job"], {"last_run": None, "running_on": None})["scan"] = {
+            "started_at": scan["started_at"],
+            "done": scan["done"],
+            "partitions": len(scan["partitions"]),
+            "partitions_done": sum(partition["done"] for partition in scan["partitions"]),
+            "rows": sum(partition["rows"] for partition in scan["partitions"]),
+        }
+    return status
@@ -0,0 +1,74 @@
+import logging
+import os
+import time
+
+import orjson
+
+# how many records with the same message each logger emits per second at INFO level and below
+LOG_RATE_LIMIT = float(os.getenv("LOG_RATE_LIMIT", 10))
+# distinct messages rate limited at once, beyond which the limits start over
+LOG_RATE_LIMIT_MESSAGES = 10000
+
+# attributes every LogRecord has, anything else was passed in `extra` and is logged as a field
+STANDARD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", None, None).__dict__) | {"message", "asctime"}
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+        Formats records as one JSON object per line, with the fields passed in `extra`.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in STANDARD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry, default=str).decode("utf-8")
+
+
+class RateLimitFilter(logging.Filter):
+    """
+        Lets through at most `rate` records per second with the same message (before formatting), so that
+        logs on the hot paths don't slow them down under load. Warnings and errors are never dropped.
+        The next record let through tells how many were dropped.
+    """
+
+    def __init__(self, rate: float = LOG_RATE_LIMIT):
+        super().__init__()
+        self.rate = rate
+        # message -> (tokens, last refill, dropped records)
+        self.buckets = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO:
+            return True
+        now = time.monotonic()
+        tokens, last_refill, dropped = self.buckets.get(record.msg, (self.rate, now, 0))
+        tokens = min(self.rate, tokens + (now - last_refill) * self.rate)
+        if len(self.buckets) > LOG_RATE_LIMIT_MESSAGES:
+            self.buckets.clear()
+        if tokens < 1:
+            self.buckets[record.msg] = (tokens, now, dropped + 1)
+            return False
+        if dropped > 0:
+            record.dropped = dropped
+        self.buckets[record.msg] = (tokens - 1, now, 0)
+        return True
+
+
+def get_logger(name: str) -> logging.Logger:
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        logger.setLevel(logging.INFO)
+        handler = logging.StreamHandler()
+        handler.setFormatter(StructuredFormatter())
+        handler.addFilter(RateLimitFilter())
+        logger.addHandler(handler)
+    return logger
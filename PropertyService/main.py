@@ -1,43 +1,100 @@
-import firebase_admin
-from fastapi import FastAPI, HTTPException, status, Depends, APIRouter
-from firebase_admin import credentials
-from pymongo import ReturnDocument
+from fastapi import FastAPI, HTTPException, status, Depends, APIRouter, Query, Request, Response
+from typing import Optional
 
 from ProjectUtils.DecoderService.decode_token import decode_token
-from PropertyService.database import collection
-from PropertyService.dependencies import get_user, get_user_email
-from PropertyService.schemas import Property, UpdateProperty, Amenity, BathroomFixture, BedType, PropertyForAnalytics
+from PropertyService.database import collection, job_state, find_in_batches, aggregate_in_batches, find_page, \
+    index_stats
+from PropertyService.cache import property_cache
+from PropertyService.dependencies import get_user, get_user_email, get_admin_user
+from PropertyService.schemas import Property, UpdateProperty, Amenity, BathroomFixture, BedType, \
+    PropertySummary, PropertySummaryPage, Catalog, BatchUpdateProperty, BatchUpdateResult
+from PropertyService.features import FEATURES_PROJECTION, feature_row, ensure_materialized_features, \
+    analytics_rows_pipeline
+from PropertyService.responses import FAST_PROPERTY_RESPONSES, fast_property_response
+from PropertyService.static_responses import amenities_response, bathroom_fixtures_response, bed_types_response, \
+    catalog_response
 from contextlib import asynccontextmanager
-from PropertyService.messaging_operations import setup, publish_update_property_message, publish_get_recommended_price, publish_send_data_to_analytics
+from PropertyService.logs import get_logger
+from PropertyService.metrics import MetricsMiddleware
+from PropertyService.jobs import recorded_job, single_flight, jobs_status
+from PropertyService.scans import sharded_scan
+from PropertyService.publisher import publisher
+from PropertyService.outbox import outbox_relay, update_property_and_notify
+from PropertyService.messaging_operations import publish_get_recommended_price, publish_send_data_to_analytics, \
+    stop_consumers
+from PropertyService.startup import initialize, exit_on_failure
+from PropertyService.updates import prepare_update, update_document, update_message, update_properties, \
+    recomputed_features
 
 import asyncio
 
-import logging
 import random
+from pymongo.errors import DuplicateKeyError
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from datetime import time
+from datetime import time, datetime, timedelta, timezone
+import os
 
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-logger.addHandler(logging.StreamHandler())
+logger = get_logger(__name__)
+
+# fields read by the scheduled jobs, everything else stays in the database
+PRICE_RECOMMENDATION_PROJECTION = FEATURES_PROJECTION
+ANALYTICS_PROJECTION = {**FEATURES_PROJECTION, "services": 1, "recommended_price": 1}
+
+# send_data_to_analytics only ships properties changed since its last run, except for a full snapshot every interval
+ANALYTICS_FULL_SNAPSHOT_INTERVAL = timedelta(hours=float(os.getenv("ANALYTICS_FULL_SNAPSHOT_INTERVAL_HOURS", 24)))
+# "aggregate" has MongoDB shape the analytics rows, "cursor" reads the documents and shapes them here
+ANALYTICS_EXPORT_MODE = os.getenv("ANALYTICS_EXPORT_MODE", "aggregate")
+ANALYTICS_EXPORT_INTERVAL = timedelta(hours=1)
+# writers stamp last_modified with their own clock before their write lands, so each run also ships the properties
+# changed this long before it started: a few duplicate rows rather than changes missed until the next full snapshot
+ANALYTICS_EXPORT_OVERLAP = timedelta(minutes=float(os.getenv("ANALYTICS_EXPORT_OVERLAP_MINUTES", 5)))
+PRICE_RECOMMENDATION_INTERVAL = timedelta(days=1)
+
+# whether every instance requests recommended prices for the whole catalog when it starts
+PRICE_RECOMMENDATION_ON_STARTUP = os.getenv("PRICE_RECOMMENDATION_ON_STARTUP", "true").lower() == "true"
+
+MAX_PAGE_SIZE = 1000
+SUMMARY_FIELDS = [field for field in PropertySummary.model_fields if field != "id"]
 
 scheduler = AsyncIOScheduler()
-scheduler.start()
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    loop = asyncio.get_event_loop()
-    await asyncio.ensure_future(setup(loop))
-    asyncio.ensure_future(price_recommendation())
+
+async def start_service(app: FastAPI):
+    await initialize(asyncio.get_running_loop())
+    if PRICE_RECOMMENDATION_ON_STARTUP:
+        asyncio.ensure_future(price_recommendation())
     daily_time = time(hour=22, minute=30) 
-    scheduler.add_job(price_recommendation, 'cron', hour=daily_time.hour, minute=daily_time.minute)
+    # a run that is still going when the next one is due makes that one be skipped, not overlapped
+    scheduler.add_job(price_recommendation, 'cron', hour=daily_time.hour, minute=daily_time.minute,
+                      max_instances=1, coalesce=True)
     #scheduler.add_job(send_data_to_analytics, 'interval', minutes=1) #test
-    scheduler.add_job(send_data_to_analytics, 'interval', hours=1)
+    scheduler.add_job(send_data_to_analytics, 'interval', seconds=ANALYTICS_EXPORT_INTERVAL.total_seconds(),
+                      max_instances=1, coalesce=True)
+    scheduler.start()
+    app.state.ready = True
+    logger.info("Service is ready")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # requests are served right away, /ready tells when the connections are up
+    app.state.ready = False
+    starting = asyncio.create_task(start_service(app), name="start_service")
+    starting.add_done_callback(exit_on_failure)
     yield
+    if not starting.done():
+        starting.cancel()
+        await asyncio.gather(starting, return_exceptions=True)
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    # the messages being handled still publish their responses, so the consumers stop before the publisher
+    await stop_consumers()
+    await outbox_relay.stop()
+    # publish what is still queued before shutting down
+    await publisher.stop()
 
-cred = credentials.Certificate(".secret.json")
-firebase_admin.initialize_app(cred)
 app = FastAPI(
     lifespan=lifespan, 
     root_path="/api/PropertyService",
@@ -47,7 +104,10 @@ app = FastAPI(
         All endpoints require authorization, verified by the Authorization bearer token.",
     version="1.0.0"
 )
+app.add_middleware(MetricsMiddleware)
 authRouter = APIRouter(dependencies=[Depends(get_user)])
+# operational endpoints, only for the users listed in ADMIN_EMAILS
+adminRouter = APIRouter(dependencies=[Depends(get_admin_user)], tags=["admin"])
 
 
 @app.get("/health", tags=["healthcheck"], summary="Perform a Health Check",
@@ -56,12 +116,93 @@ def get_health():
     return {"status": "ok"}
 
 
+@app.get("/ready", tags=["healthcheck"], summary="Perform a Readiness Check",
+         response_description="Return HTTP Status Code 200 (OK) once the connections to MongoDB, RabbitMQ and Firebase \
+             are up and the scheduled jobs are registered, 503 (Service Unavailable) until then.",
+         status_code=status.HTTP_200_OK)
+def get_ready(request: Request):
+    if not getattr(request.app.state, "ready", False):
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Service is starting")
+    return {"status": "ready"}
+
+
+@app.get("/metrics", tags=["healthcheck"], summary="Get the service's metrics in Prometheus text format",
+         response_description="Return request, consumer, publish, MongoDB command and scheduled job metrics.",
+         include_in_schema=False)
+def get_metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@adminRouter.get("/admin/indexes",
+                summary="List the indexes of the properties collection and their usage.",
+                response_description="Return, for each index, its key and how many operations used it since the given date.")
+async def get_index_stats():
+    return await index_stats()
+
+
+@adminRouter.get("/admin/cache",
+                summary="Get the statistics of the property cache.",
+                response_description="Return the cache backend, its size and its hit and miss counters.")
+async def get_cache_stats():
+    return property_cache.stats()
+
+
+@adminRouter.get("/admin/outbox",
+                summary="Get the statistics of the property update outbox.",
+                response_description="Return how many updates wait to be relayed to the wrappers, the age of the oldest one \
+                    and how many were relayed or failed since startup.")
+async def get_outbox_stats():
+    return await outbox_relay.stats()
+
+
+@adminRouter.get("/admin/jobs",
+                summary="Get the status of the scheduled jobs.",
+                response_description="Return, for each scheduled job, its last run (duration, rows and status) \
+                    and the instance running it right now, if any.")
+async def get_jobs_status():
+    return await jobs_status()
+
+
 @authRouter.get("/properties", response_model=list[Property],
                 summary="List all properties for a specific user.",
-                response_description="Return a list of all properties for a user, based on his authorization token."
+                response_description="Return a list of all properties for a user, based on his authorization token. \
+                    If there are more properties, the X-Next-Cursor header holds the `after_id` of the next page."
                 )
-async def read_properties(user_email: str = Depends(get_user_email)):
-    return await collection.find({"user_email": user_email}).to_list(1000)
+async def read_properties(res: Response, after_id: Optional[int] = None,
+                          limit: int = Query(default=MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                          user_email: str = Depends(get_user_email)):
+    page_key = f"full:{after_id}:{limit}"
+    properties, next_cursor = await property_cache.get_page(
+        user_email, page_key, lambda: find_page(user_email, after_id, limit)
+    )
+    headers = {} if next_cursor is None else {"X-Next-Cursor": str(next_cursor)}
+    if FAST_PROPERTY_RESPONSES:
+        return fast_property_response(properties, by_alias=True, headers=headers)
+    res.headers.update(headers)
+    return properties
+
+
+@authRouter.get("/properties/summaries", response_model=PropertySummaryPage, response_model_by_alias=False,
+                response_model_exclude_unset=True,
+                summary="List summaries of the properties of a specific user, one page at a time.",
+                response_description="Return a page of property summaries for a user, based on his authorization token, \
+                    and the `after_id` of the next page. `fields` is a comma separated subset of the summary fields.",
+                responses={
+                    status.HTTP_400_BAD_REQUEST: {
+                        "description": "Unknown summary field requested.",
+                        "content": {"application/json": {"example": {"detail": "Unknown fields: description."}}}
+                    }
+                })
+async def read_property_summaries(after_id: Optional[int] = None, limit: int = Query(default=50, ge=1, le=MAX_PAGE_SIZE),
+                                  fields: Optional[str] = None, user_email: str = Depends(get_user_email)):
+    requested_fields = SUMMARY_FIELDS if fields is None else [field.strip() for field in fields.split(",") if field.strip()]
+    if unknown_fields := [field for field in requested_fields if field not in SUMMARY_FIELDS]:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown fields: {', '.join(unknown_fields)}.")
+    page_key = f"summaries:{after_id}:{limit}:{','.join(requested_fields)}"
+    properties, next_cursor = await property_cache.get_page(
+        user_email, page_key, lambda: find_page(user_email, after_id, limit, {field: 1 for field in ["_id", *requested_fields]})
+    )
+    return {"items": properties, "next_cursor": next_cursor}
 
 
 @authRouter.get("/properties/{prop_id}", response_model=Property, response_model_by_alias=False,
@@ -74,8 +215,13 @@ async def read_properties(user_email: str = Depends(get_user_email)):
                     }
                 })
 async def read_property(prop_id: int, user_email: str = Depends(get_user_email)):
-    if (result := await collection.find_one({"_id": prop_id, "user_email": user_email})) is None:
+    result = await property_cache.get_property(
+        user_email, prop_id, lambda: collection.find_one({"_id": prop_id, "user_email": user_email})
+    )
+    if result is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Property {prop_id} not found for user {user_email}")
+    if FAST_PROPERTY_RESPONSES:
+        return fast_property_response(result)
     return result
 
 
@@ -86,38 +232,73 @@ async def read_property(prop_id: int, user_email: str = Depends(get_user_email))
                     status.HTTP_404_NOT_FOUND: {
                         "description": "Property not found for given user.",
                         "content": {"application/json": {"example": {"detail": "Property 0 not found for user user@example.com."}}}
+                    },
+                    status.HTTP_409_CONFLICT: {
+                        "description": "The user already has another property with the given address.",
+                        "content": {"application/json": {"example": {"detail": "User user@example.com already has a property with address Rua 1, Aveiro"}}}
                     }
                 })
 async def update_property(prop_id: int, prop: UpdateProperty, user_email: str = Depends(get_user_email)):
-    upd_prop = {k: v for k, v in prop.model_dump().items() if v is not None}
-
+    upd_prop = prepare_update(prop)
 
     # The update is empty, but we should still return the matching document:
     if len(upd_prop) <= 0:
-        return await read_property(prop_id)
-    
-    if "recommended_price" in upd_prop and "update_price_automatically" in upd_prop and upd_prop.get("update_price_automatically") is True and upd_prop.get("price") != upd_prop.get("recommended_price"):
-        upd_prop["price"] = upd_prop.get("recommended_price")
+        return await read_property(prop_id, user_email)
 
-    update_result = await collection.find_one_and_update(
-        {"_id": prop_id, "user_email": user_email},
-        {"$set": upd_prop},
-        return_document=ReturnDocument.AFTER,
-    )
+    # the wrappers are notified through the outbox, so the request doesn't wait for the broker
+    try:
+        update_result = await update_property_and_notify(
+            {"_id": prop_id, "user_email": user_email},
+            update_document(
+                upd_prop, datetime.now(timezone.utc), (await recomputed_features(user_email, {prop_id: upd_prop})).get(prop_id)
+            ),
+            lambda updated_property: update_message(upd_prop, updated_property.get("after_commission")),
+        )
+    except DuplicateKeyError:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail=f"User {user_email} already has a property with address {upd_prop.get('address')}")
     if update_result is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Property {prop_id} not found for user {user_email}")
-    
-    upd_attributes = upd_prop.keys()
-    # make sure "after_commission" is always included in the message sent to wrappers
-    if "price" in upd_attributes and "after_commission" not in upd_attributes:
-        upd_prop["after_commission"] = update_result.get("after_commission")
+    await property_cache.invalidate(user_email)
 
+    if FAST_PROPERTY_RESPONSES:
+        return fast_property_response(update_result)
+    return update_result
 
-    await publish_update_property_message(prop_id, upd_prop)
 
-    return update_result
+@authRouter.patch("/properties", response_model=BatchUpdateResult,
+                  summary="Update many properties of a specific user at once.",
+                  response_description="Return, for each property, whether it was updated, left unchanged (empty update), \
+                      not found for the user, or failed to be updated.",
+                  responses={
+                      status.HTTP_200_OK: {
+                          "description": "Return the result of the update of each property.",
+                          "content": {"application/json": {"example": {"results": [
+                              {"prop_id": 1, "status": "updated"},
+                              {"prop_id": 2, "status": "not_found"}
+                          ]}}}
+                      }
+                  })
+async def update_properties_batch(batch: BatchUpdateProperty, user_email: str = Depends(get_user_email)):
+    updates = {}
+    if batch.items is not None:
+        for item in batch.items:
+            # later updates of the same property win
+            updates.setdefault(item.prop_id, {}).update(prepare_update(item.update))
+    else:
+        upd_prop = prepare_update(batch.update)
+        property_filter = {"user_email": user_email}
+        if batch.filter is not None and batch.filter.prop_ids is not None:
+            property_filter["_id"] = {"$in": batch.filter.prop_ids}
+        if batch.filter is not None and batch.filter.location is not None:
+            property_filter["location"] = batch.filter.location
+        async for prop in collection.find(property_filter, {"_id": 1}):
+            updates[prop["_id"]] = upd_prop
+
+    statuses = await update_properties(user_email, updates)
+    return {"results": [{"prop_id": prop_id, "status": update_status} for prop_id, update_status in statuses.items()]}
+
 
-    
 @authRouter.get("/amenities", response_model=list[Amenity],
                 summary="List all available amenities.",
                 response_description="Return a list of all available amenities.",
@@ -129,8 +310,8 @@ async def update_property(prop_id: int, prop: UpdateProperty, user_email: str =
                         }}
                     }
                 })
-async def get_amenities():
-    return [a.value for a in Amenity]
+async def get_amenities(request: Request):
+    return amenities_response.response(request)
     
 
 @authRouter.get("/bathroom_fixtures", response_model=list[BathroomFixture],
@@ -142,8 +323,8 @@ async def get_amenities():
                         "content": {"application/json": {"example": ["bathtub", "shower", "bidet", "toilet"]}}
                     }
                 })
-async def get_bathroom_fixtures():
-    return [bf.value for bf in BathroomFixture]
+async def get_bathroom_fixtures(request: Request):
+    return bathroom_fixtures_response.response(request)
 
 
 @authRouter.get("/bed_types", response_model=list[BedType],
@@ -157,74 +338,107 @@ async def get_bathroom_fixtures():
                         }}
                     }
                 })
-async def get_bed_types():
-    return [b.value for b in BedType]
+async def get_bed_types(request: Request):
+    return bed_types_response.response(request)
+
+
+@authRouter.get("/catalog", response_model=Catalog,
+                summary="List all available amenities, bathroom fixtures and bed types.",
+                response_description="Return the lists of all available amenities, bathroom fixtures and bed types.",
+                responses={
+                    status.HTTP_200_OK: {
+                        "description": "Return the lists of all available amenities, bathroom fixtures and bed types.",
+                        "content": {"application/json": {
+                            "example": {
+                                "amenities": ["free_wifi", "parking_space", "air_conditioner", "pool", "kitchen"],
+                                "bathroom_fixtures": ["bathtub", "shower", "bidet", "toilet"],
+                                "bed_types": ["single", "queen", "king"]
+                            }
+                        }}
+                    }
+                })
+async def get_catalog(request: Request):
+    return catalog_response.response(request)
 
 """
     Called periodically to send AnalyticsService a message to get recommended prices, including
     the properties' relevant features for price recommendation.
 """
+async def request_recommended_prices(properties: list[dict]):
+    await ensure_materialized_features(properties)
+    # rows shaped as PropertyForAnalytics
+    rows = []
+    for prop in properties:
+        row = feature_row(prop)
+        row["latitude"] = round(random.uniform(36, 42), 5)
+        row["longitude"] = round(random.uniform(-9.5, -7), 5)
+        rows.append(row)
+    await publish_get_recommended_price(rows)
+
+
+# every instance may join the scan, each partition of the catalog is only processed by one of them
+@recorded_job("price_recommendation")
 async def price_recommendation():
-    properties = await collection.find().to_list(1000)
     logger.info("Sending price recommendation request")
-    propertiesAnalytics = []
-    if properties != []: 
+    sent = await sharded_scan(
+        "price_recommendation", PRICE_RECOMMENDATION_INTERVAL, request_recommended_prices,
+        projection=PRICE_RECOMMENDATION_PROJECTION
+    )
+    if sent is None:
+        return None
+    return {"message": "Price recommendation request sent", "rows": sent}
+    
+
+async def analytics_rows(export_filter: dict):
+    """
+        Analytics rows of the properties matching `export_filter`, shaped from the documents in batches.
+    """
+    async for properties in find_in_batches(export_filter, ANALYTICS_PROJECTION):
+        await ensure_materialized_features(properties)
+        propertiesAnalytics = []
         for prop in properties:
-            bedrooms = prop["bedrooms"]
-            num_beds = 0
-            for key, value in bedrooms.items():
-                num_beds += value["beds"][0]["number_beds"]
-                
-            propertyAnalytics = PropertyForAnalytics(
-                id = prop["_id"].__str__(),
-                latitude= round(random.uniform(36, 42), 5),
-                longitude= round(random.uniform(-9.5, -7), 5),
-                bathrooms = len(prop["bathrooms"].keys()),
-                bedrooms = len(prop["bedrooms"].keys()),
-                beds= num_beds,
-                number_of_guests = prop["number_guests"],
-                num_amenities = len(prop["amenities"]),
-                location = prop["location"],
-                price = prop["price"])
-            
+            propertyAnalytics = feature_row(prop)
+            propertyAnalytics["services"] = prop["services"]
+            propertyAnalytics["recommended_price"] = prop.get("recommended_price")
             propertiesAnalytics.append(propertyAnalytics)
-        
-        await publish_get_recommended_price(propertiesAnalytics)
-        return {"message": "Price recommendation request sent"}
-    
+        yield propertiesAnalytics
+
 
 """
     Called periodically to send AnalyticsService a message with data for analytics purposes.
     Sent data excludes anything that connects the property to a specific owner, such as their e-mail.
 """
+@single_flight("send_data_to_analytics", ANALYTICS_EXPORT_INTERVAL)
 async def send_data_to_analytics():
-    properties = await collection.find().to_list(1000)
-    logger.info("Sending data to analytics")
-    propertiesAnalytics = []
-    if properties != []: 
-        for prop in properties:
-            bedrooms = prop["bedrooms"]
-            num_beds = 0
-            for key, value in bedrooms.items():
-                num_beds += value["beds"][0]["number_beds"]
-            
-            propertyAnalytics = {
-                "id": prop["_id"].__str__(),
-                "bathrooms": len(prop["bathrooms"].keys()),
-                "bedrooms": len(prop["bedrooms"].keys()),
-                "beds": num_beds,
-                "number_of_guests": prop["number_guests"],
-                "num_amenities": len(prop["amenities"]),
-                "location": prop["location"],
-                "price": prop["price"],
-                "services": prop["services"],
-                "recommended_price": prop["recommended_price"]
-            }
-            
-            propertiesAnalytics.append(propertyAnalytics)
-        
+    started_at = datetime.now(timezone.utc)
+    export_state = await job_state.find_one({"_id": "send_data_to_analytics"}) or {}
+    full_snapshot = export_state.get("watermark") is None or \
+        export_state.get("last_full_snapshot") is None or \
+        export_state["last_full_snapshot"] + ANALYTICS_FULL_SNAPSHOT_INTERVAL <= started_at.replace(tzinfo=None)
+    if full_snapshot:
+        logger.info("Sending data to analytics (full snapshot)")
+        export_filter = {}
+    else:
+        logger.info("Sending data to analytics (changed properties)", extra={"since": export_state["watermark"]})
+        export_filter = {"last_modified": {"$gte": export_state["watermark"]}}
+
+    if ANALYTICS_EXPORT_MODE == "aggregate":
+        batches = aggregate_in_batches(analytics_rows_pipeline(export_filter))
+    else:
+        batches = analytics_rows(export_filter)
+
+    sent = 0
+    async for propertiesAnalytics in batches:
         await publish_send_data_to_analytics(propertiesAnalytics)
+        sent += len(propertiesAnalytics)
+
+    # the watermark only moves once every batch has been published, so a failed run is retried in full
+    new_export_state = {"watermark": started_at - ANALYTICS_EXPORT_OVERLAP}
+    if full_snapshot:
+        new_export_state["last_full_snapshot"] = started_at
+    await job_state.update_one({"_id": "send_data_to_analytics"}, {"$set": new_export_state}, upsert=True)
 
-        return {"message": "Data sent to analytics"}
+    return {"message": "Data sent to analytics", "rows": sent}
 
+app.include_router(adminRouter)
 app.include_router(authRouter, tags=["properties"])
@@ -1,5 +1,7 @@
 import json
-from aio_pika import connect_robust, ExchangeType, Message
+import os
+from datetime import datetime, timezone
+from aio_pika import connect_robust, Message
 from ProjectUtils.MessagingService.queue_definitions import (
     channel,
     USER_QUEUE_NAME,
@@ -12,34 +14,64 @@ from ProjectUtils.MessagingService.queue_definitions import (
     ANALYTICS_TO_PROPERTY_QUEUE_NAME,
     PROPERTY_TO_ANALYTICS_DATA_ROUTING_KEY, PROPERTY_TO_CALENDAR_ROUTING_KEY
 )
+from pydantic import ValidationError
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from PropertyService.cache import property_cache
+from PropertyService.consumers import ShardedConsumer
 from PropertyService.database import collection
+from PropertyService.features import materialized_features
+from PropertyService.logs import get_logger
+from PropertyService.metrics import PUBLISH_DURATION, observe_duration
+from PropertyService.encoding import ACCEPTED_CONTENT_TYPES, decode_message, encode_message
+from PropertyService.outbox import bulk_write_and_notify
+from PropertyService.publisher import publisher
 from PropertyService.schemas import Property, Service
 
-from ProjectUtils.MessagingService.schemas import to_json_aoi_bytes, MessageFactory, MessageType, from_json
-from ProjectUtils.MessagingService.queue_definitions import routing_key_by_service, WRAPPER_BROADCAST_ROUTING_KEY
+from ProjectUtils.MessagingService.schemas import to_json_aoi_bytes, MessageFactory, MessageType
+from ProjectUtils.MessagingService.queue_definitions import routing_key_by_service
 
-# TODO: fix this in the future
-channel.close()  # don't use the channel from this file, we need to use an async channel
+logger = get_logger(__name__)
 
-async_exchange = None
+# messages delivered to each queue's consumer before being acknowledged, and how many of them are processed at once
+USER_QUEUE_PREFETCH = int(os.getenv("USER_QUEUE_PREFETCH", 10))
+USER_QUEUE_CONSUMERS = int(os.getenv("USER_QUEUE_CONSUMERS", 1))
+WRAPPERS_QUEUE_PREFETCH = int(os.getenv("WRAPPERS_QUEUE_PREFETCH", 16))
+WRAPPERS_QUEUE_CONSUMERS = int(os.getenv("WRAPPERS_QUEUE_CONSUMERS", 8))
+PRICE_RECOMENDATION_QUEUE_PREFETCH = int(os.getenv("PRICE_RECOMENDATION_QUEUE_PREFETCH", 4))
+PRICE_RECOMENDATION_QUEUE_CONSUMERS = int(os.getenv("PRICE_RECOMENDATION_QUEUE_CONSUMERS", 2))
 
+RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbit_mq")
 
-async def setup(loop):
-    connection = await connect_robust(host="rabbit_mq", loop=loop)
+# (queue, consumer tag, callback) of every queue consumed by setup, stopped by stop_consumers
+consumers = []
 
-    async_channel = await connection.channel()
 
-    global async_exchange
+def close_blocking_channel():
+    # TODO: fix this in the future
+    # ProjectUtils opens this blocking channel when imported, we don't use it, we need to use an async channel
+    channel.close()
 
-    async_exchange = await async_channel.declare_exchange(
-        name=EXCHANGE_NAME, type=ExchangeType.TOPIC, durable=True
-    )
 
-    users_queue = await async_channel.declare_queue(USER_QUEUE_NAME, durable=True)
+async def setup(loop):
+    connection = await connect_robust(host=RABBITMQ_HOST, loop=loop)
 
-    wrappers_queue = await async_channel.declare_queue(WRAPPER_TO_APP_QUEUE, durable=True)
+    # declares the exchange the queues are bound to
+    await publisher.start(connection)
 
-    priceRecomendation_queue = await async_channel.declare_queue(ANALYTICS_TO_PROPERTY_QUEUE_NAME, durable=True)
+    # each queue is consumed on its own channel, so a slow consumer doesn't hold back the others
+    users_channel = await connection.channel()
+    await users_channel.set_qos(prefetch_count=USER_QUEUE_PREFETCH)
+    users_queue = await users_channel.declare_queue(USER_QUEUE_NAME, durable=True)
+
+    wrappers_channel = await connection.channel()
+    await wrappers_channel.set_qos(prefetch_count=WRAPPERS_QUEUE_PREFETCH)
+    wrappers_queue = await wrappers_channel.declare_queue(WRAPPER_TO_APP_QUEUE, durable=True)
+
+    price_recomendation_channel = await connection.channel()
+    await price_recomendation_channel.set_qos(prefetch_count=PRICE_RECOMENDATION_QUEUE_PREFETCH)
+    priceRecomendation_queue = await price_recomendation_channel.declare_queue(ANALYTICS_TO_PROPERTY_QUEUE_NAME, durable=True)
 
     await users_queue.bind(exchange=EXCHANGE_NAME, routing_key=USER_QUEUE_ROUTING_KEY)
 
@@ -47,144 +79,244 @@ async def setup(loop):
         exchange=EXCHANGE_NAME, routing_key=WRAPPER_TO_APP_ROUTING_KEY
     )
 
-    await users_queue.consume(callback=consume_user_message)
+    await consume(users_queue, ShardedConsumer(consume_user_message, USER_QUEUE_CONSUMERS))
 
-    await wrappers_queue.consume(callback=consume_wrappers_message)
+    # imports of the same user are processed in order, so that duplicate addresses are always detected,
+    # each message is decoded once, to find its user and then to import it
+    await consume(wrappers_queue, ShardedConsumer(
+        consume_wrappers_message, WRAPPERS_QUEUE_CONSUMERS, wrappers_message_user, decode=decode_message
+    ))
 
-    await priceRecomendation_queue.consume(callback=consume_price_recomendation)
+    # the recommended prices aren't sharded: a response covers properties of many users, so two responses
+    # handled at once may store their prices in any order
+    await consume(
+        priceRecomendation_queue, ShardedConsumer(consume_price_recomendation, PRICE_RECOMENDATION_QUEUE_CONSUMERS)
+    )
 
     return connection
 
 
+async def consume(queue, callback: ShardedConsumer):
+    consumers.append((queue, await queue.consume(callback=callback.start()), callback))
+
+
+async def stop_consumers():
+    """
+        Stops the deliveries of every queue, then waits for the messages already delivered to be processed,
+        so that the messages they publish are queued before the publisher stops.
+    """
+    for queue, consumer_tag, _ in consumers:
+        try:
+            await queue.cancel(consumer_tag)
+        except Exception as e:
+            logger.warning("Could not cancel a queue consumer", extra={"queue": queue.name, "error": str(e)})
+    for _, _, callback in consumers:
+        await callback.stop()
+    consumers.clear()
+
+
+def wrappers_message_user(decoded_message):
+    """
+        Shard key of the messages of the wrappers queue: the e-mail of the user whose properties are imported.
+    """
+    properties = decoded_message.body.get("properties") or [{}]
+    return properties[0].get("user_email")
+
+
 async def consume_user_message(incoming_message):
-    print("Received Message @ Users queue")
+    logger.info("Received message @ Users queue", extra={"queue": USER_QUEUE_NAME})
     async with incoming_message.process():
         try:
-            decoded_message = from_json(incoming_message.body)
+            decoded_message = decode_message(incoming_message)
         except Exception as e:
-            print("Error while processing message:", e)
-        print(incoming_message.body)
+            logger.error("Error while processing message", extra={"queue": USER_QUEUE_NAME, "error": str(e)})
+        logger.debug("Message body", extra={"queue": USER_QUEUE_NAME, "body": incoming_message.body})
 
 
-async def consume_wrappers_message(incoming_message):
-    print("Received Message @ Wrappers queue")
+async def consume_wrappers_message(incoming_message, decoded_message=None):
+    logger.info("Received message @ Wrappers queue", extra={"queue": WRAPPER_TO_APP_QUEUE})
     async with incoming_message.process():
         try:
-            decoded_message = from_json(incoming_message.body)
+            if decoded_message is None:
+                decoded_message = decode_message(incoming_message)
             if decoded_message.message_type == MessageType.PROPERTY_IMPORT_RESPONSE:
                 body = decoded_message.body
                 await import_properties(body["service"], body["properties"])
         except Exception as e:
-            print("Error while processing message in Wrappers queue:", e)
+            logger.error("Error while processing message", extra={"queue": WRAPPER_TO_APP_QUEUE, "error": str(e)})
 
 
 async def import_properties(service: str, properties):
-    global async_exchange
-    print("IMPORT_PROPERTIES_RESPONSE - importing properties...")
-    if len(properties) > 0:
-        user_email = properties[0]["user_email"]
-        old_new_id_map = {}
-
-        for prop in properties:
-            property_same_address = await collection.find_one(
-                {"address": prop.get("address"), "user_email": user_email}
-            )
-            if property_same_address is None:
-                prop["services"] = [Service(service)]
+    """
+        Imports a batch of properties coming from a wrapper with a single address lookup and a single
+        unordered bulk write. Returns how many properties were inserted, merged into an existing
+        property with the same address, or failed.
+    """
+    import_result = {"inserted": 0, "merged": 0, "failed": 0}
+    if len(properties) <= 0:
+        return import_result
+
+    user_email = properties[0]["user_email"]
+    new_service = Service(service)
+    old_new_id_map = {}
+    now = datetime.now(timezone.utc)
+
+    properties_by_address = {}
+    async for property_same_address in collection.find(
+        {"user_email": user_email, "address": {"$in": list({prop.get("address") for prop in properties})}},
+        {"address": 1, "services": 1}
+    ):
+        properties_by_address[property_same_address["address"]] = property_same_address
+
+    operations = []
+    inserted_ids = []  # id of the property inserted by each operation, None for service updates
+    for prop in properties:
+        property_same_address = properties_by_address.get(prop.get("address"))
+        if property_same_address is None:
+            prop["services"] = [new_service]
+            try:
                 serialized_prop = Property.model_validate(prop)
-                await collection.insert_one(serialized_prop.model_dump(by_alias=True))
-                await publish_email_id_mapping_to_calendar_service(user_email, serialized_prop.id)
-            else:  # duplicate property
-                old_id = prop["_id"]
-                new_id = property_same_address["_id"]
-                # set old_new_id_map to notify wrappers of duplicate property
-                if old_id != new_id:
-                    old_new_id_map[old_id] = new_id
-                # set new services list in property schema
-                new_service = Service(service)
-                if new_service not in property_same_address["services"]:
-                    property_same_address["services"].append(Service(service))
-                    await collection.update_one(
-                        {"_id": new_id},
-                        {"$set": {"services": property_same_address["services"]}}
-                    )
-
-        await async_exchange.publish(
-            routing_key=routing_key_by_service[service],
-            message=to_json_aoi_bytes(MessageFactory.create_reservation_import_initial_request_message(
-                user_email,
-                old_new_id_map
-            ))
-        )
-
-
-async def publish_update_property_message(prop_id: int, prop: dict):
-    global async_exchange
-    print(f"UPDATING PROPERTY {prop}")
-    await async_exchange.publish(
-        routing_key=WRAPPER_BROADCAST_ROUTING_KEY,
-        message=to_json_aoi_bytes(MessageFactory.create_property_update_message(prop_id, prop))
+            except ValidationError as e:
+                logger.warning("Invalid property in import", extra={"prop_id": prop.get("_id"), "error": str(e)})
+                import_result["failed"] += 1
+                continue
+            document = serialized_prop.model_dump(by_alias=True)
+            operations.append(InsertOne({**document, "features": materialized_features(document), "last_modified": now}))
+            inserted_ids.append(serialized_prop.id)
+            # properties later in the batch with the same address are merged into this one
+            properties_by_address[serialized_prop.address] = {"_id": serialized_prop.id, "services": [new_service]}
+        else:  # duplicate property
+            old_id = prop["_id"]
+            new_id = property_same_address["_id"]
+            # set old_new_id_map to notify wrappers of duplicate property
+            if old_id != new_id:
+                old_new_id_map[old_id] = new_id
+            if new_service not in property_same_address["services"]:
+                property_same_address["services"].append(new_service)
+                operations.append(UpdateOne(
+                    {"_id": new_id},
+                    {"$addToSet": {"services": new_service.value}, "$set": {"last_modified": now}}
+                ))
+                inserted_ids.append(None)
+            import_result["merged"] += 1
+
+    failed_operations = set()
+    if len(operations) > 0:
+        try:
+            await collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            logger.error("Error while importing properties", extra={"errors": e.details["writeErrors"]})
+            failed_operations = {error["index"] for error in e.details["writeErrors"]}
+
+    new_prop_ids = []
+    for index, prop_id in enumerate(inserted_ids):
+        if prop_id is None:
+            continue
+        if index in failed_operations:
+            import_result["failed"] += 1
+        else:
+            new_prop_ids.append(prop_id)
+    import_result["inserted"] = len(new_prop_ids)
+    await property_cache.invalidate(user_email)
+
+    await publish_email_id_mappings_to_calendar_service(user_email, new_prop_ids)
+
+    await publisher.publish(
+        routing_key_by_service[service],
+        to_json_aoi_bytes(MessageFactory.create_reservation_import_initial_request_message(
+            user_email,
+            old_new_id_map
+        ))
     )
-
-    print("Craete Property Update Message", MessageFactory.create_property_update_message(prop_id, prop).__dict__)
+    logger.info("Properties imported", extra={"service": service, **import_result})
+    return import_result
 
 
-async def publish_get_recommended_price(properties: list):
-    global async_exchange
-    print("Sending price recommendation request")
-    json_properties = [property.model_dump() for property in properties]
-    message = MessageFactory.create_get_recommended_price(json_properties)
-    await async_exchange.publish(
-        routing_key=PROPERTY_TO_ANALYTICS_QUEUE_ROUTING_KEY,
-        message=to_json_aoi_bytes(message)
+@observe_duration(PUBLISH_DURATION, "publish_get_recommended_price")
+async def publish_get_recommended_price(properties: list[dict]):
+    message = MessageFactory.create_get_recommended_price(properties)
+    await publisher.publish_and_wait(
+        PROPERTY_TO_ANALYTICS_QUEUE_ROUTING_KEY,
+        # the recommended prices may be sent back in any of the content types we decode
+        encode_message(message, columnar=True, headers={"x-accept": ACCEPTED_CONTENT_TYPES})
     )
-    print("Price recommendation request sent")
 
 
 async def consume_price_recomendation(incoming_message):
-    print("Received Message @ Price Recomendation queue")
+    logger.info("Received message @ Price Recomendation queue", extra={"queue": ANALYTICS_TO_PROPERTY_QUEUE_NAME})
     async with incoming_message.process():
         try:
-            decoded_message = from_json(incoming_message.body)
+            decoded_message = decode_message(incoming_message)
             if decoded_message.message_type == MessageType.RECOMMENDED_PRICE_RESPONSE:
-                for prop in decoded_message.body:
-                    property = await collection.find_one({"_id": int(prop)})
-                    if "update_price_automatically" in property and property.get(
-                            "update_price_automatically") is True and property.get("price") != decoded_message.body[
-                        prop]:
-                        await collection.find_one_and_update(
-                            {"_id": int(prop)},
-                            {"$set": {"recommended_price": decoded_message.body[prop],
-                                      "price": decoded_message.body[prop]}}
-                        )
-                        await publish_update_property_message(int(prop), {"price": decoded_message.body[prop]})
-                    else:
-                        await collection.find_one_and_update(
-                            {"_id": int(prop)},
-                            {"$set": {"recommended_price": decoded_message.body[prop]}}
-                        )
-
-            print("Price recommendation response processed")
+                await apply_recommended_prices(
+                    {int(prop_id): price for prop_id, price in decoded_message.body.items()}
+                )
         except Exception as e:
-            print("Error while processing message:", e)
-
-
+            logger.error("Error while processing message", extra={"queue": ANALYTICS_TO_PROPERTY_QUEUE_NAME, "error": str(e)})
+
+
+async def apply_recommended_prices(recommended_prices: dict[int, float]):
+    """
+        Stores the recommended prices with one lookup and one bulk write. Properties that update their
+        price automatically also get their price changed, and the wrappers are notified of it through the outbox.
+    """
+    now = datetime.now(timezone.utc)
+    operations = []
+    prop_ids = []  # property written by each operation
+    price_updates = {}
+    updated_users = set()
+    async for property in collection.find(
+        {"_id": {"$in": list(recommended_prices)}},
+        {"user_email": 1, "price": 1, "recommended_price": 1, "update_price_automatically": 1, "after_commission": 1}
+    ):
+        recommended_price = recommended_prices[property["_id"]]
+        if property.get("update_price_automatically") is True and property.get("price") != recommended_price:
+            operations.append(UpdateOne(
+                {"_id": property["_id"]},
+                {"$set": {"recommended_price": recommended_price, "price": recommended_price, "last_modified": now}}
+            ))
+            price_updates[property["_id"]] = {
+                "price": recommended_price,
+                "after_commission": property.get("after_commission", False)
+            }
+        elif property.get("recommended_price") != recommended_price:
+            operations.append(UpdateOne(
+                {"_id": property["_id"]},
+                {"$set": {"recommended_price": recommended_price, "last_modified": now}}
+            ))
+        else:
+            continue
+        prop_ids.append(property["_id"])
+        updated_users.add(property["user_email"])
+
+    # the wrappers are notified through the outbox, which merges these with other recent updates
+    # the properties written before a failed operation still have to be dropped from the cache
+    try:
+        if len(operations) > 0:
+            await bulk_write_and_notify(operations, price_updates, prop_ids)
+    finally:
+        for user_email in updated_users:
+            await property_cache.invalidate(user_email)
+
+
+@observe_duration(PUBLISH_DURATION, "publish_send_data_to_analytics")
 async def publish_send_data_to_analytics(properties: list):
-    global async_exchange
-    print("Sending data to analytics")
     message = MessageFactory.create_send_data_to_analytics_message(properties)
-    await async_exchange.publish(
-        routing_key=PROPERTY_TO_ANALYTICS_DATA_ROUTING_KEY,
-        message=to_json_aoi_bytes(message)
-    )
-    print("Data sent to analytics")
+    await publisher.publish_and_wait(PROPERTY_TO_ANALYTICS_DATA_ROUTING_KEY, encode_message(message, columnar=True))
 
 
+@observe_duration(PUBLISH_DURATION, "publish_email_id_mapping_to_calendar_service")
 async def publish_email_id_mapping_to_calendar_service(email: str, prop_id: int):
-    global async_exchange
-    print(f"Publishing property id {prop_id} to calendar service")
-    await async_exchange.publish(
-        routing_key=PROPERTY_TO_CALENDAR_ROUTING_KEY,
-        message=to_json_aoi_bytes(MessageFactory.create_email_property_id_mapping_message(email, prop_id))
+    await publisher.publish(
+        PROPERTY_TO_CALENDAR_ROUTING_KEY,
+        to_json_aoi_bytes(MessageFactory.create_email_property_id_mapping_message(email, prop_id))
     )
-    print("Property id published to calendar service")
+
+
+async def publish_email_id_mappings_to_calendar_service(email: str, prop_ids: list[int]):
+    """
+        Queues the email-property id mappings of a whole import at once. The calendar service expects
+        one mapping per message, the publisher sends them in batches.
+    """
+    for prop_id in prop_ids:
+        await publish_email_id_mapping_to_calendar_service(email, prop_id)
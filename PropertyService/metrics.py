@@ -0,0 +1,111 @@
+import functools
+import time
+
+from prometheus_client import Counter, Histogram
+from pymongo import monitoring
+
+REQUEST_DURATION = Histogram(
+    "propertyservice_http_request_duration_seconds", "Time spent handling HTTP requests, by route.",
+    ["method", "route", "status"]
+)
+CONSUMER_DURATION = Histogram(
+    "propertyservice_consumer_duration_seconds", "Time spent processing a queue message, by consumer callback.",
+    ["consumer"]
+)
+CONSUMER_LAG = Histogram(
+    "propertyservice_consumer_lag_seconds",
+    "Time a delivered message waited before its consumer callback started processing it.",
+    ["consumer"]
+)
+PUBLISH_DURATION = Histogram(
+    "propertyservice_publish_duration_seconds", "Time spent in the publish helpers, by helper.", ["helper"]
+)
+PUBLISH_FAILURES = Counter(
+    "propertyservice_publish_failures_total", "Messages the broker failed to confirm, by routing key.", ["routing_key"]
+)
+MONGO_COMMAND_DURATION = Histogram(
+    "propertyservice_mongo_command_duration_seconds", "Duration of MongoDB commands, by command and collection.",
+    ["command", "collection"]
+)
+MONGO_COMMAND_FAILURES = Counter(
+    "propertyservice_mongo_command_failures_total", "Failed MongoDB commands, by command and collection.",
+    ["command", "collection"]
+)
+JOB_DURATION = Histogram(
+    "propertyservice_job_duration_seconds", "Duration of the scheduled jobs' runs.", ["job", "status"],
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, float("inf"))
+)
+JOB_ROWS = Counter("propertyservice_job_rows_total", "Properties sent by the scheduled jobs.", ["job"])
+
+
+def observe_duration(histogram: Histogram, *labels: str):
+    """
+        Decorator observing in `histogram` how long each call of an async function takes.
+    """
+    observed = histogram.labels(*labels)
+
+    def decorator(function):
+        @functools.wraps(function)
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                observed.observe(time.perf_counter() - start)
+        return timed
+    return decorator
+
+
+class MetricsMiddleware:
+    """
+        ASGI middleware observing the duration of each request, labelled with the path template
+        of the route that handled it so that the number of series stays bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            REQUEST_DURATION.labels(
+                scope["method"], route.path if route is not None else "unmatched", str(status_code)
+            ).observe(time.perf_counter() - start)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """
+        pymongo command listener observing the duration of every command sent to MongoDB.
+    """
+
+    def __init__(self):
+        # (connection, request id) -> collection of the commands in flight
+        self.collections = {}
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        # getMore names the collection in a field of its own, its first value is the cursor id
+        collection = event.command.get("collection" if event.command_name == "getMore" else event.command_name)
+        self.collections[(event.connection_id, event.request_id)] = collection if isinstance(collection, str) else ""
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        collection = self.collections.pop((event.connection_id, event.request_id), "")
+        MONGO_COMMAND_DURATION.labels(event.command_name, collection).observe(event.duration_micros / 1e6)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        collection = self.collections.pop((event.connection_id, event.request_id), "")
+        MONGO_COMMAND_DURATION.labels(event.command_name, collection).observe(event.duration_micros / 1e6)
+        MONGO_COMMAND_FAILURES.labels(event.command_name, collection).inc()
@@ -0,0 +1,32 @@
+"""
+    One-off data migrations, run with `python -m PropertyService.migrations <migration>`.
+"""
+import asyncio
+import sys
+
+from PropertyService.database import collection
+from PropertyService.features import MATERIALIZED_FEATURES_EXPRESSION, MISSING_FEATURES_FILTER
+
+
+async def backfill_features():
+    """
+        Materializes the features of the properties stored before they were maintained on write,
+        including those that only got some of them from an update.
+    """
+    result = await collection.update_many(
+        MISSING_FEATURES_FILTER,
+        [{"$set": {"features": MATERIALIZED_FEATURES_EXPRESSION}}]
+    )
+    print(f"Features materialized for {result.modified_count} properties")
+
+
+MIGRATIONS = {
+    "backfill_features": backfill_features,
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] not in MIGRATIONS:
+        print(f"Usage: python -m PropertyService.migrations [{'|'.join(MIGRATIONS)}]")
+        sys.exit(1)
+    asyncio.run(MIGRATIONS[sys.argv[1]]())
@@ -0,0 +1,252 @@
+import asyncio
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional
+
+from pymongo import ReturnDocument, UpdateMany
+from pymongo.errors import BulkWriteError
+
+from ProjectUtils.MessagingService.schemas import to_json_aoi_bytes, MessageFactory
+from ProjectUtils.MessagingService.queue_definitions import WRAPPER_BROADCAST_ROUTING_KEY
+from PropertyService.database import client, collection, outbox, supports_transactions
+from PropertyService.logs import get_logger
+from PropertyService.publisher import publisher
+
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 500))
+# how often the relay looks for entries when it isn't woken up by a new one
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 1))
+# how long a relay keeps the entries it claimed before other replicas may relay them
+OUTBOX_CLAIM_TIMEOUT = timedelta(seconds=float(os.getenv("OUTBOX_CLAIM_TIMEOUT", 60)))
+OUTBOX_MAX_RETRY_DELAY = float(os.getenv("OUTBOX_MAX_RETRY_DELAY", 300))
+# updates of the same property within this window are merged into a single message to the wrappers
+PROPERTY_UPDATE_COALESCE_WINDOW = timedelta(seconds=float(os.getenv("PROPERTY_UPDATE_COALESCE_WINDOW", 2)))
+
+logger = get_logger(__name__)
+
+
+def outbox_entry(prop_id: int, update: dict, now: datetime) -> dict:
+    return {
+        "prop_id": prop_id,
+        "update": update,
+        "created_at": now,
+        "available_at": now + PROPERTY_UPDATE_COALESCE_WINDOW,
+        "claimed_until": None,
+        "attempts": 0,
+    }
+
+
+def merge_property_updates(updates: list[dict]) -> dict:
+    """
+        Merges the $set diffs of a property, oldest first, into one update where the last write of
+        each field wins. Since every diff that changes the price carries after_commission, a merged
+        price always goes along with the latest after_commission.
+    """
+    merged = {}
+    for update in updates:
+        merged.update(update)
+    return merged
+
+
+class OutboxRelay:
+    """
+        Background task that drains the outbox to the exchange in batches. All the pending entries of
+        a property are merged into one update message, and only deleted once the broker confirmed it.
+        Failed messages are retried with exponential backoff.
+    """
+
+    def __init__(self, batch_size: int = OUTBOX_BATCH_SIZE, poll_interval: float = OUTBOX_POLL_INTERVAL):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.transactions = False
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.stopping = False
+        self.relayed = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.started_at = None
+
+    async def start(self):
+        self.transactions = await supports_transactions()
+        if not self.transactions:
+            logger.info("MongoDB doesn't support transactions, outbox entries are written right after the property updates")
+        self.started_at = datetime.now(timezone.utc)
+        self.stopping = False
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            # wait_for swallows a cancellation that comes as the relay is woken up (fixed in Python 3.12),
+            # so the relay also stops at its next iteration
+            self.stopping = True
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def notify(self):
+        self.wakeup.set()
+
+    async def _run(self):
+        while not self.stopping:
+            self.wakeup.clear()
+            try:
+                relayed = await self.relay_batch()
+            except Exception as e:
+                logger.error("Error while relaying the outbox", extra={"error": str(e)})
+                relayed = 0
+            if relayed < self.batch_size:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+                    # new entries only become available once their coalescing window is over
+                    await asyncio.sleep(PROPERTY_UPDATE_COALESCE_WINDOW.total_seconds())
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _claim_batch(self) -> list[dict]:
+        now = datetime.now(timezone.utc)
+        unclaimed = {"$or": [{"claimed_until": None}, {"claimed_until": {"$lte": now}}]}
+        prop_ids = list({
+            entry["prop_id"] async for entry in outbox.find(
+                {"available_at": {"$lte": now}, **unclaimed}, {"prop_id": 1}
+            ).sort("_id", 1).limit(self.batch_size)
+        })
+        if len(prop_ids) == 0:
+            return []
+        # the claim includes the entries of these properties still within their window, they are merged now
+        claim = uuid.uuid4().hex
+        await outbox.update_many(
+            {"prop_id": {"$in": prop_ids}, **unclaimed},
+            {"$set": {"claimed_until": now + OUTBOX_CLAIM_TIMEOUT, "claim": claim}}
+        )
+        return await outbox.find({"prop_id": {"$in": prop_ids}, "claim": claim}).sort("_id", 1).to_list(None)
+
+    async def relay_batch(self) -> int:
+        entries = await self._claim_batch()
+        if len(entries) == 0:
+            return 0
+
+        entries_by_property = {}
+        for entry in entries:
+            entries_by_property.setdefault(entry["prop_id"], []).append(entry)
+
+        confirmations = [
+            await publisher.publish(
+                WRAPPER_BROADCAST_ROUTING_KEY,
+                to_json_aoi_bytes(MessageFactory.create_property_update_message(
+                    prop_id, merge_property_updates([entry["update"] for entry in property_entries])
+                ))
+            )
+            for prop_id, property_entries in entries_by_property.items()
+        ]
+        results = await asyncio.gather(*confirmations, return_exceptions=True)
+
+        now = datetime.now(timezone.utc)
+        relayed_ids = []
+        retries = []
+        for property_entries, result in zip(entries_by_property.values(), results):
+            if isinstance(result, BaseException):
+                attempts = max(entry["attempts"] for entry in property_entries)
+                retry_delay = min(2 ** attempts, OUTBOX_MAX_RETRY_DELAY)
+                retries.append(UpdateMany(
+                    {"_id": {"$in": [entry["_id"] for entry in property_entries]}},
+                    {"$set": {"available_at": now + timedelta(seconds=retry_delay), "claimed_until": None},
+                     "$inc": {"attempts": 1}}
+                ))
+            else:
+                relayed_ids.extend(entry["_id"] for entry in property_entries)
+
+        if len(relayed_ids) > 0:
+            await outbox.delete_many({"_id": {"$in": relayed_ids}})
+        if len(retries) > 0:
+            await outbox.bulk_write(retries, ordered=False)
+        self.relayed += len(entries_by_property) - len(retries)
+        self.coalesced += len(relayed_ids) - (len(entries_by_property) - len(retries))
+        self.failed += len(retries)
+        return len(entries)
+
+    async def stats(self) -> dict:
+        pending = await outbox.count_documents({})
+        oldest = await outbox.find_one({}, {"created_at": 1}, sort=[("_id", 1)])
+        now = datetime.now(timezone.utc)
+        lag = None
+        if oldest is not None:
+            lag = (now.replace(tzinfo=None) - oldest["created_at"].replace(tzinfo=None)).total_seconds()
+        uptime = (now - self.started_at).total_seconds() if self.started_at is not None else None
+        return {
+            "pending": pending,
+            "lag_seconds": lag,
+            "relayed": self.relayed,
+            "coalesced": self.coalesced,
+            "failed": self.failed,
+            "relayed_per_second": self.relayed / uptime if uptime else None,
+            "transactions": self.transactions,
+        }
+
+
+outbox_relay = OutboxRelay()
+
+
+async def update_property_and_notify(filter: dict, update: dict, message_for: Callable[[dict], dict]) -> Optional[dict]:
+    """
+        Applies `update` to the property matching `filter` and stores in the outbox the update message
+        that `message_for` builds from the updated property, in the same transaction when MongoDB
+        supports them. Returns the updated property, or None if no property matched.
+    """
+    async def apply(session=None):
+        updated = await collection.find_one_and_update(
+            filter, update, return_document=ReturnDocument.AFTER, session=session
+        )
+        if updated is not None:
+            await outbox.insert_one(
+                outbox_entry(updated["_id"], message_for(updated), datetime.now(timezone.utc)), session=session
+            )
+        return updated
+
+    if outbox_relay.transactions:
+        async with await client.start_session() as session:
+            updated = await session.with_transaction(apply)
+    else:
+        updated = await apply()
+
+    if updated is not None:
+        outbox_relay.notify()
+    return updated
+
+
+async def bulk_write_and_notify(operations: list, updates: dict[int, dict], prop_ids: Optional[list[int]] = None):
+    """
+        Applies the bulk write `operations` on the properties collection and stores in the outbox
+        the update message of each property in `updates`, in the same transaction when MongoDB supports them.
+        Returns the BulkWriteResult.
+        If some operations fail, the BulkWriteError is raised. Without transactions the other operations
+        were applied, so when `prop_ids` gives the property each operation writes, their messages are still stored.
+    """
+    async def store_messages(updates, session=None):
+        if len(updates) > 0:
+            now = datetime.now(timezone.utc)
+            await outbox.insert_many(
+                [outbox_entry(prop_id, update, now) for prop_id, update in updates.items()], session=session
+            )
+
+    async def apply(session=None):
+        try:
+            result = await collection.bulk_write(operations, ordered=False, session=session)
+        except BulkWriteError as e:
+            if session is None and prop_ids is not None:
+                failed_ids = {prop_ids[error["index"]] for error in e.details["writeErrors"]}
+                await store_messages({prop_id: update for prop_id, update in updates.items() if prop_id not in failed_ids})
+                outbox_relay.notify()
+            raise
+        await store_messages(updates, session)
+        return result
+
+    if outbox_relay.transactions:
+        async with await client.start_session() as session:
+            result = await session.with_transaction(apply)
+    else:
+        result = await apply()
+
+    if len(updates) > 0:
+        outbox_relay.notify()
+    return result
@@ -0,0 +1,126 @@
+import asyncio
+import os
+import zlib
+
+from aio_pika import ExchangeType, Message
+from aio_pika.abc import AbstractRobustConnection
+
+from ProjectUtils.MessagingService.queue_definitions import EXCHANGE_NAME
+from PropertyService.logs import get_logger
+from PropertyService.metrics import PUBLISH_FAILURES
+
+logger = get_logger(__name__)
+
+# channels, with publisher confirms, used to publish to the exchange
+PUBLISHER_CHANNELS = int(os.getenv("PUBLISHER_CHANNELS", 4))
+# how long the first message of a batch waits for others before the batch is published
+PUBLISHER_LINGER = float(os.getenv("PUBLISHER_LINGER_MS", 5)) / 1000
+PUBLISHER_BATCH_SIZE = int(os.getenv("PUBLISHER_BATCH_SIZE", 256))
+# messages waiting to be published, publish() waits for room once it is full
+PUBLISHER_QUEUE_SIZE = int(os.getenv("PUBLISHER_QUEUE_SIZE", 10000))
+
+
+class Publisher:
+    """
+        Publishes messages to the exchange in the background. Messages are queued and published in batches:
+        the messages of a batch with the same routing key are pipelined on the same channel, in order, and
+        their publisher confirms are awaited together. The next batch is only published once the broker
+        confirmed the previous one, so when the broker is slow the queue fills up and publishers wait.
+    """
+
+    def __init__(self, channels: int = PUBLISHER_CHANNELS, linger: float = PUBLISHER_LINGER,
+                 batch_size: int = PUBLISHER_BATCH_SIZE, queue_size: int = PUBLISHER_QUEUE_SIZE):
+        self.channels = channels
+        self.linger = linger
+        self.batch_size = batch_size
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.exchanges = []
+        self.flusher = None
+        self.published = 0
+        self.failed = 0
+
+    async def start(self, connection: AbstractRobustConnection):
+        # may be called again after a failed startup, with a new connection
+        exchanges = []
+        for _ in range(self.channels):
+            channel = await connection.channel(publisher_confirms=True)
+            exchanges.append(await channel.declare_exchange(name=EXCHANGE_NAME, type=ExchangeType.TOPIC, durable=True))
+        self.exchanges = exchanges
+        if self.flusher is None:
+            self.flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self.flusher is not None:
+            await self.queue.join()
+            self.flusher.cancel()
+            self.flusher = None
+
+    async def publish(self, routing_key: str, message: Message) -> asyncio.Future:
+        """
+            Queues a message, waiting only if the queue is full. Returns a future resolved once the broker
+            confirms the message, that callers may ignore.
+        """
+        confirmation = asyncio.get_running_loop().create_future()
+        await self.queue.put((routing_key, message, confirmation))
+        return confirmation
+
+    async def publish_and_wait(self, routing_key: str, message: Message):
+        await (await self.publish(routing_key, message))
+
+    async def _next_batch(self) -> list:
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.linger
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            if (timeout := deadline - loop.time()) <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _flush_loop(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                by_routing_key = {}
+                for routing_key, message, confirmation in batch:
+                    by_routing_key.setdefault(routing_key, []).append((message, confirmation))
+                await asyncio.gather(*(
+                    self._publish_in_order(routing_key, messages) for routing_key, messages in by_routing_key.items()
+                ))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def _publish_in_order(self, routing_key: str, messages: list):
+        exchange = self.exchanges[zlib.crc32(routing_key.encode("utf-8")) % len(self.exchanges)]
+        results = await asyncio.gather(
+            *(exchange.publish(message, routing_key=routing_key) for message, _ in messages),
+            return_exceptions=True
+        )
+        for (_, confirmation), result in zip(messages, results):
+            if confirmation.done():
+                continue
+            if isinstance(result, BaseException):
+                self.failed += 1
+                PUBLISH_FAILURES.labels(routing_key).inc()
+                logger.error("Error while publishing message", extra={"routing_key": routing_key, "error": str(result)})
+                confirmation.set_exception(result)
+                # the error was reported, don't warn about it if nobody awaits the confirmation
+                confirmation.exception()
+            else:
+                self.published += 1
+                confirmation.set_result(result)
+
+    def stats(self) -> dict:
+        return {"queued": self.queue.qsize(), "published": self.published, "failed": self.failed}
+
+
+publisher = Publisher()
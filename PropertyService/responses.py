@@ -0,0 +1,41 @@
+import os
+
+import orjson
+from fastapi import Response
+
+from PropertyService.schemas import Property
+
+# Serve property documents read from our own collection without validating them against Property again.
+FAST_PROPERTY_RESPONSES = os.getenv("FAST_PROPERTY_RESPONSES", "false").lower() == "true"
+
+PROPERTY_FIELDS = [field for field in Property.model_fields if field != "id"]
+PROPERTY_DEFAULTS = {
+    field: info.default for field, info in Property.model_fields.items() if field != "id" and not info.is_required()
+}
+
+
+class PropertyJSONResponse(Response):
+    """
+        JSON response serialized straight to bytes with orjson, skipping response_model validation.
+    """
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+def property_document(document: dict, by_alias: bool = False) -> dict:
+    """
+        Shapes a stored property as the Property response model would: only its fields, with their
+        defaults, and the id under `_id` or `id` depending on `by_alias`.
+    """
+    shaped = {"_id" if by_alias else "id": document.get("_id")}
+    for field in PROPERTY_FIELDS:
+        shaped[field] = document.get(field, PROPERTY_DEFAULTS.get(field))
+    return shaped
+
+
+def fast_property_response(content, by_alias: bool = False, headers: dict = None) -> PropertyJSONResponse:
+    if isinstance(content, list):
+        return PropertyJSONResponse([property_document(document, by_alias) for document in content], headers=headers)
+    return PropertyJSONResponse(property_document(content, by_alias), headers=headers)
@@ -0,0 +1,142 @@
+import asyncio
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Optional
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError
+
+from PropertyService.database import collection, job_state, find_in_batches
+from PropertyService.jobs import JOB_PERIOD_SLACK, as_utc, lease
+from PropertyService.logs import get_logger
+
+logger = get_logger(__name__)
+
+# _id ranges a catalog scan is split into
+SCAN_PARTITIONS = int(os.getenv("SCAN_PARTITIONS", 8))
+# partitions of a scan processed at once by each instance
+SCAN_CONCURRENCY = int(os.getenv("SCAN_CONCURRENCY", 4))
+
+
+async def partition_bounds(partitions: int) -> list[dict]:
+    """
+        Splits the property ids into `partitions` contiguous ranges of about the same width.
+        The first and last ranges are open ended, so properties created during a scan are still covered.
+    """
+    lowest = await collection.find_one({}, {"_id": 1}, sort=[("_id", ASCENDING)])
+    highest = await collection.find_one({}, {"_id": 1}, sort=[("_id", DESCENDING)])
+    if lowest is None:
+        return [{"lower": None, "upper": None}]
+    width = (highest["_id"] - lowest["_id"] + 1) / partitions
+    bounds = [None] + [lowest["_id"] + round(width * i) for i in range(1, partitions)] + [None]
+    return [{"lower": bounds[i], "upper": bounds[i + 1]} for i in range(partitions)]
+
+
+async def current_scan(name: str, period: timedelta) -> Optional[dict]:
+    """
+        The scan of job `name` that is in progress, a new one if the last scan finished over a `period` ago,
+        None if it finished more recently. Instances racing to start a scan all end up with the same one.
+    """
+    scan_id = f"{name}:scan"
+    scan = await job_state.find_one({"_id": scan_id})
+    if scan is not None and not scan["done"]:
+        return scan
+    if scan is not None and as_utc(scan["finished_at"]) + period * JOB_PERIOD_SLACK > datetime.now(timezone.utc):
+        return None
+
+    new_scan = {
+        "_id": scan_id,
+        "job": name,
+        "run_id": uuid.uuid4().hex,
+        "started_at": datetime.now(timezone.utc),
+        "done": False,
+        "partitions": [
+            {**bounds, "checkpoint": None, "done": False, "rows": 0}
+            for bounds in await partition_bounds(SCAN_PARTITIONS)
+        ],
+    }
+    try:
+        if scan is None:
+            await job_state.insert_one(new_scan)
+        else:
+            await job_state.replace_one({"_id": scan_id, "run_id": scan["run_id"]}, new_scan)
+    except DuplicateKeyError:  # another instance started the scan first
+        pass
+    return await job_state.find_one({"_id": scan_id})
+
+
+async def scan_partition(scan: dict, index: int, filter: dict, projection: dict,
+                         process_batch: Callable[[list[dict]], Awaitable]) -> int:
+    """
+        Processes the properties of one partition of a scan in _id order, checkpointing the last processed
+        id after every batch. Returns the number of processed properties, 0 if another run holds the partition.
+    """
+    async with lease(f"{scan['job']}:{scan['run_id']}:{index}") as held:
+        if not held:
+            return 0
+        # the partition may have moved on since the scan was read
+        progress = await job_state.find_one({"_id": scan["_id"], "run_id": scan["run_id"]}, {"partitions": 1})
+        if progress is None or progress["partitions"][index]["done"]:
+            return 0
+        partition = progress["partitions"][index]
+
+        id_range = {}
+        if partition["checkpoint"] is not None:
+            id_range["$gt"] = partition["checkpoint"]
+        elif partition["lower"] is not None:
+            id_range["$gte"] = partition["lower"]
+        if partition["upper"] is not None:
+            id_range["$lt"] = partition["upper"]
+        partition_filter = {**filter, "_id": id_range} if id_range else filter
+
+        processed = 0
+        async for properties in find_in_batches(partition_filter, projection, sort=[("_id", ASCENDING)]):
+            await process_batch(properties)
+            processed += len(properties)
+            await job_state.update_one(
+                {"_id": scan["_id"], "run_id": scan["run_id"]},
+                {"$set": {f"partitions.{index}.checkpoint": properties[-1]["_id"]},
+                 "$inc": {f"partitions.{index}.rows": len(properties)}}
+            )
+        await job_state.update_one(
+            {"_id": scan["_id"], "run_id": scan["run_id"]}, {"$set": {f"partitions.{index}.done": True}}
+        )
+        return processed
+
+
+async def sharded_scan(name: str, period: timedelta, process_batch: Callable[[list[dict]], Awaitable],
+                       filter: Optional[dict] = None, projection: Optional[dict] = None) -> Optional[int]:
+    """
+        Scans the properties matching `filter` in _id range partitions, up to SCAN_CONCURRENCY at once,
+        calling `process_batch` with every batch. Each partition is leased, so several instances may
+        work on the same scan, and checkpointed, so a scan interrupted by a crash or a redeploy resumes
+        where it stopped the next time the job runs. A new scan only starts once the last one finished
+        a `period` ago, so instances starting or scheduled at other times don't scan the catalog again.
+        Returns the number of properties processed here, None if there was nothing to scan.
+    """
+    scan = await current_scan(name, period)
+    if scan is None:
+        logger.info("Skipping scan, the last one finished within its period", extra={"job": name})
+        return None
+    semaphore = asyncio.Semaphore(SCAN_CONCURRENCY)
+
+    async def run_partition(index):
+        async with semaphore:
+            return await scan_partition(scan, index, filter or {}, projection, process_batch)
+
+    results = await asyncio.gather(*(
+        run_partition(index) for index, partition in enumerate(scan["partitions"]) if not partition["done"]
+    ), return_exceptions=True)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if len(errors) > 0:
+        # the failed partitions resume from their checkpoint on the next run
+        raise errors[0]
+    # the last instance to finish a partition closes the scan
+    finished = await job_state.update_one(
+        {"_id": scan["_id"], "run_id": scan["run_id"], "done": False, "partitions.done": {"$ne": False}},
+        {"$set": {"done": True, "finished_at": datetime.now(timezone.utc)}}
+    )
+    if finished.modified_count > 0:
+        logger.info("Scan finished", extra={"job": name})
+    return sum(results)
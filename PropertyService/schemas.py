@@ -1,5 +1,5 @@
 from typing import Optional, Annotated
-from pydantic import BaseModel, BeforeValidator, Field, EmailStr
+from pydantic import BaseModel, BeforeValidator, Field, EmailStr, model_validator
 from pydantic_extra_types.phone_numbers import PhoneNumber
 from enum import Enum
 
@@ -137,6 +137,78 @@ class UpdateProperty(PropertyBase):
     update_price_automatically: Optional[bool] = None
 
 
+# Most properties a batch update can list one by one.
+MAX_BATCH_UPDATE_ITEMS = 1000
+
+
+class PropertyUpdateItem(BaseModel):
+    prop_id: int
+    update: UpdateProperty
+
+
+class PropertyFilter(BaseModel):
+    # Selects the caller's properties matching every given field, all of them if none is given.
+    prop_ids: Optional[list[int]] = None
+    location: Optional[str] = None
+
+
+class BatchUpdateProperty(BaseModel):
+    # Either `items`, each with its own update, or one `update` applied to the properties matching `filter`.
+    items: Optional[list[PropertyUpdateItem]] = Field(default=None, max_length=MAX_BATCH_UPDATE_ITEMS)
+    filter: Optional[PropertyFilter] = None
+    update: Optional[UpdateProperty] = None
+
+    @model_validator(mode="after")
+    def check_mode(self):
+        if (self.items is None) == (self.update is None):
+            raise ValueError("Either items or update (with an optional filter) must be given")
+        if self.items is not None and self.filter is not None:
+            raise ValueError("filter only applies to update")
+        return self
+
+
+class UpdateStatus(str, Enum):
+    UPDATED = "updated"
+    UNCHANGED = "unchanged"
+    NOT_FOUND = "not_found"
+    FAILED = "failed"
+
+
+class PropertyUpdateResult(BaseModel):
+    prop_id: int
+    status: UpdateStatus
+
+
+class BatchUpdateResult(BaseModel):
+    results: list[PropertyUpdateResult]
+
+
+class PropertySummary(PropertyBase):
+    # Lightweight view of a property for list pages. Every field but the id is optional,
+    # since clients can choose which ones are returned.
+    id: int = Field(alias="_id")
+    title: Optional[str] = None
+    address: Optional[str] = None
+    location: Optional[str] = None
+    price: Optional[float] = None
+    number_guests: Optional[int] = None
+    services: Optional[list[Service]] = None
+    recommended_price: Optional[float] = None
+    update_price_automatically: Optional[bool] = None
+
+
+class PropertySummaryPage(BaseModel):
+    items: list[PropertySummary]
+    # id to pass as `after_id` to get the next page, None on the last page
+    next_cursor: Optional[int] = None
+
+
+class Catalog(BaseModel):
+    amenities: list[Amenity]
+    bathroom_fixtures: list[BathroomFixture]
+    bed_types: list[BedType]
+
+
 class PropertyForAnalytics(BaseModel):
     id: str
     latitude: float
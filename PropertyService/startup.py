@@ -0,0 +1,86 @@
+import asyncio
+import os
+import signal
+
+import firebase_admin
+from firebase_admin import credentials
+
+from PropertyService.database import client, ensure_indexes
+from PropertyService.logs import get_logger
+from PropertyService.messaging_operations import close_blocking_channel, setup
+from PropertyService.outbox import outbox_relay
+
+logger = get_logger(__name__)
+
+# service account key used to verify the users' tokens
+FIREBASE_CREDENTIALS = os.getenv("FIREBASE_CREDENTIALS", ".secret.json")
+# upper bound of the delay between attempts of a startup step that failed
+STARTUP_MAX_RETRY_DELAY = float(os.getenv("STARTUP_MAX_RETRY_DELAY", 30))
+
+
+def init_firebase():
+    # reads the key file and builds the credentials, so it runs off the event loop
+    firebase_admin.initialize_app(credentials.Certificate(FIREBASE_CREDENTIALS))
+
+
+async def ping_mongo():
+    await client.admin.command("ping")
+
+
+async def close_unused_channel():
+    # best effort, the channel isn't used, so the service can start without closing it
+    try:
+        await asyncio.to_thread(close_blocking_channel)
+    except Exception as e:
+        logger.warning("Could not close the blocking channel", extra={"error": str(e)})
+
+
+def log_failure(task: asyncio.Task) -> bool:
+    """
+        Done callback of a background task logging the exception it failed with, if any.
+        Returns whether it failed.
+    """
+    if task.cancelled() or task.exception() is None:
+        return False
+    logger.error("Background task failed", extra={"task": task.get_name(), "error": str(task.exception())},
+                 exc_info=task.exception())
+    return True
+
+
+def exit_on_failure(task: asyncio.Task):
+    """
+        Done callback of the startup task: a service that failed to start would never be ready,
+        so it logs the error and shuts the process down gracefully, to be restarted.
+    """
+    if log_failure(task):
+        logger.error("Startup failed, shutting down", extra={"task": task.get_name()})
+        os.kill(os.getpid(), signal.SIGTERM)
+
+
+async def with_retries(name: str, step):
+    """
+        Runs a startup step until it succeeds, waiting longer after each failure.
+    """
+    delay = 1
+    while True:
+        try:
+            return await step()
+        except Exception as e:
+            logger.error("Startup step failed, retrying", extra={"step": name, "error": str(e), "retry_in": delay})
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, STARTUP_MAX_RETRY_DELAY)
+
+
+async def initialize(loop):
+    """
+        Connects to MongoDB, RabbitMQ and Firebase concurrently, then starts the outbox relay.
+        The indexes are built in the background, the service is usable while they are.
+    """
+    await asyncio.gather(
+        with_retries("firebase", lambda: asyncio.to_thread(init_firebase)),
+        with_retries("mongo", ping_mongo),
+        with_retries("broker", lambda: setup(loop)),
+        close_unused_channel(),
+    )
+    await with_retries("outbox", outbox_relay.start)
+    asyncio.create_task(ensure_indexes(), name="ensure_indexes").add_done_callback(log_failure)
@@ -0,0 +1,47 @@
+import hashlib
+import json
+
+from fastapi import Request, Response, status
+
+from PropertyService.schemas import Amenity, BathroomFixture, BedType
+
+# the catalogs only change with a new deployment, which changes their ETag
+CATALOG_CACHE_CONTROL = "private, max-age=3600"
+
+
+class StaticJSONResponse:
+    """
+        JSON content serialized once, served with a strong ETag and answered with
+        304 Not Modified when the client already holds the same version.
+    """
+
+    def __init__(self, content):
+        self.body = json.dumps(content, separators=(",", ":")).encode("utf-8")
+        self.etag = f'"{hashlib.sha256(self.body).hexdigest()}"'
+        self.headers = {"ETag": self.etag, "Cache-Control": CATALOG_CACHE_CONTROL}
+
+    def not_modified(self, request: Request) -> bool:
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match is None:
+            return False
+        # If-None-Match uses the weak comparison (RFC 7232), proxies may send our ETag back as weak
+        return any(etag.strip().removeprefix("W/") in (self.etag, "*") for etag in if_none_match.split(","))
+
+    def response(self, request: Request) -> Response:
+        if self.not_modified(request):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=self.headers)
+        return Response(content=self.body, media_type="application/json", headers=self.headers)
+
+
+AMENITIES = [a.value for a in Amenity]
+BATHROOM_FIXTURES = [bf.value for bf in BathroomFixture]
+BED_TYPES = [b.value for b in BedType]
+
+amenities_response = StaticJSONResponse(AMENITIES)
+bathroom_fixtures_response = StaticJSONResponse(BATHROOM_FIXTURES)
+bed_types_response = StaticJSONResponse(BED_TYPES)
+catalog_response = StaticJSONResponse({
+    "amenities": AMENITIES,
+    "bathroom_fixtures": BATHROOM_FIXTURES,
+    "bed_types": BED_TYPES,
+})
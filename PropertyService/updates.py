@@ -0,0 +1,103 @@
+from datetime import datetime, timezone
+from typing import Optional
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from PropertyService.cache import property_cache
+from PropertyService.database import collection
+from PropertyService.features import MATERIALIZED_FEATURES_SOURCES, MISSING_FEATURES_FILTER, changes_features, \
+    materialized_features, materialized_features_update
+from PropertyService.outbox import bulk_write_and_notify, outbox_relay
+from PropertyService.schemas import UpdateProperty, UpdateStatus
+
+
+def prepare_update(prop: UpdateProperty) -> dict:
+    """
+        Fields set by an update, with the price following the recommended price for properties updated automatically.
+    """
+    upd_prop = {k: v for k, v in prop.model_dump().items() if v is not None}
+    if "recommended_price" in upd_prop and "update_price_automatically" in upd_prop and upd_prop.get("update_price_automatically") is True and upd_prop.get("price") != upd_prop.get("recommended_price"):
+        upd_prop["price"] = upd_prop.get("recommended_price")
+    return upd_prop
+
+
+def update_document(upd_prop: dict, now: datetime, features: Optional[dict] = None) -> dict:
+    """
+        $set of an update. `features` replaces all the materialized features, otherwise only those
+        derived from the updated fields are set.
+    """
+    features_update = {"features": features} if features is not None else materialized_features_update(upd_prop)
+    return {"$set": {**upd_prop, **features_update, "last_modified": now}}
+
+
+async def recomputed_features(user_email: str, updates: dict[int, dict]) -> dict[int, dict]:
+    """
+        Full features, once updated, of the properties whose update changes them but that don't have all
+        of them materialized: setting only the changed ones would leave their features incomplete.
+    """
+    prop_ids = [prop_id for prop_id, upd_prop in updates.items() if changes_features(upd_prop)]
+    if len(prop_ids) == 0:
+        return {}
+    return {
+        prop["_id"]: materialized_features({**prop, **updates[prop["_id"]]})
+        async for prop in collection.find(
+            {"_id": {"$in": prop_ids}, "user_email": user_email, **MISSING_FEATURES_FILTER}, MATERIALIZED_FEATURES_SOURCES
+        )
+    }
+
+
+def update_message(upd_prop: dict, after_commission) -> dict:
+    """
+        Update message sent to the wrappers, given the property's after_commission once updated.
+    """
+    message = dict(upd_prop)
+    # make sure "after_commission" is always included in the message sent to wrappers
+    if "price" in message and "after_commission" not in message:
+        message["after_commission"] = after_commission
+    return message
+
+
+async def update_properties(user_email: str, updates: dict[int, dict]) -> dict[int, UpdateStatus]:
+    """
+        Applies prepared updates to properties of a user with one lookup, checking they own them, and one
+        unordered bulk write. The wrappers are notified of each updated property through the outbox.
+        Returns the status of each property.
+    """
+    after_commission_by_id = {
+        prop["_id"]: prop.get("after_commission")
+        async for prop in collection.find(
+            {"_id": {"$in": list(updates)}, "user_email": user_email}, {"after_commission": 1}
+        )
+    }
+
+    features_by_id = await recomputed_features(user_email, updates)
+    now = datetime.now(timezone.utc)
+    statuses = {}
+    operations = []
+    prop_ids = []
+    messages = {}
+    for prop_id, upd_prop in updates.items():
+        if prop_id not in after_commission_by_id:
+            statuses[prop_id] = UpdateStatus.NOT_FOUND
+        elif len(upd_prop) <= 0:
+            statuses[prop_id] = UpdateStatus.UNCHANGED
+        else:
+            operations.append(UpdateOne(
+                {"_id": prop_id, "user_email": user_email}, update_document(upd_prop, now, features_by_id.get(prop_id))
+            ))
+            prop_ids.append(prop_id)
+            messages[prop_id] = update_message(upd_prop, upd_prop.get("after_commission", after_commission_by_id[prop_id]))
+            statuses[prop_id] = UpdateStatus.UPDATED
+
+    if len(operations) > 0:
+        try:
+            await bulk_write_and_notify(operations, messages, prop_ids)
+        except BulkWriteError as e:
+            # within a transaction nothing was written
+            failed_indexes = range(len(prop_ids)) if outbox_relay.transactions else \
+                [error["index"] for error in e.details["writeErrors"]]
+            for index in failed_indexes:
+                statuses[prop_ids[index]] = UpdateStatus.FAILED
+        await property_cache.invalidate(user_email)
+    return statuses
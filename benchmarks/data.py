@@ -0,0 +1,49 @@
+import random
+
+from PropertyService.schemas import Amenity, BathroomFixture, BedType, Service
+
+
+def make_property(prop_id: int, user_email: str = "owner@example.com", rng: random.Random = random) -> dict:
+    """
+        Synthetic property document, shaped as stored in the properties collection.
+    """
+    return {
+        "_id": prop_id,
+        "user_email": user_email,
+        "title": f"Property {prop_id}",
+        "address": f"Rua {prop_id}, Aveiro",
+        "location": rng.choice(["Aveiro", "Porto", "Lisboa", "Coimbra", "Faro"]),
+        "description": "A cozy apartment close to the city center. " * 10,
+        "price": float(rng.randint(30, 300)),
+        "number_guests": rng.randint(1, 10),
+        "square_meters": rng.randint(20, 300),
+        "bedrooms": {
+            f"bedroom{i}": {"beds": [{"number_beds": rng.randint(1, 2), "type": rng.choice(list(BedType)).value}]}
+            for i in range(rng.randint(1, 4))
+        },
+        "bathrooms": {
+            f"bathroom{i}": {"fixtures": rng.sample([f.value for f in BathroomFixture], 2)}
+            for i in range(rng.randint(1, 3))
+        },
+        "amenities": rng.sample([a.value for a in Amenity], rng.randint(0, len(Amenity))),
+        "after_commission": False,
+        "house_rules": {
+            "check_in": {"begin_time": "15:00", "end_time": "20:00"},
+            "check_out": {"begin_time": "08:00", "end_time": "11:00"},
+            "smoking": False,
+            "parties": False,
+            "rest_time": {"begin_time": "22:00", "end_time": "08:00"},
+            "allow_pets": rng.random() < 0.5,
+        },
+        "additional_info": "Towels and bed linen included.",
+        "cancellation_policy": "Free cancellation up to 48 hours before check-in.",
+        "contacts": [{"name": "Owner", "phone_number": "+351912345678"}],
+        "services": [rng.choice(list(Service)).value],
+        "recommended_price": None,
+        "update_price_automatically": False,
+    }
+
+
+def make_catalog(size: int, users: int = 1, seed: int = 0) -> list[dict]:
+    rng = random.Random(seed)
+    return [make_property(prop_id, f"owner{prop_id % users}@example.com", rng) for prop_id in range(1, size + 1)]
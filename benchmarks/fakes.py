@@ -0,0 +1,182 @@
+"""
+    In-process stand-ins for the services PropertyService talks to, so that it can be benchmarked
+    without MongoDB, RabbitMQ or Firebase. install() must run before PropertyService is imported.
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from fastapi import HTTPException, status
+
+
+class StubBlockingChannel:
+    """
+        Blocking pika channel opened by ProjectUtils at import, every call is a no-op.
+    """
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class StubBlockingConnection:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def channel(self, *args, **kwargs):
+        return StubBlockingChannel()
+
+    def close(self):
+        pass
+
+
+def topic_matches(pattern: str, routing_key: str) -> bool:
+    def match(pattern_words, key_words):
+        if len(pattern_words) == 0:
+            return len(key_words) == 0
+        if pattern_words[0] == "#":
+            return any(match(pattern_words[1:], key_words[i:]) for i in range(len(key_words) + 1))
+        if len(key_words) == 0:
+            return False
+        return pattern_words[0] in ("*", key_words[0]) and match(pattern_words[1:], key_words[1:])
+
+    return match(pattern.split("."), routing_key.split("."))
+
+
+class FakeIncomingMessage:
+    def __init__(self, message, routing_key: str):
+        self.body = message.body
+        self.content_type = message.content_type
+        self.content_encoding = message.content_encoding
+        self.headers = message.headers
+        self.routing_key = routing_key
+        # resolved once the consumer is done with the message
+        self.processed = asyncio.get_running_loop().create_future()
+
+    @asynccontextmanager
+    async def process(self):
+        try:
+            yield
+        finally:
+            if not self.processed.done():
+                self.processed.set_result(None)
+
+
+class FakeQueue:
+    def __init__(self, broker: "FakeBroker", name: str):
+        self.broker = broker
+        self.name = name
+        self.consumer = None
+
+    async def bind(self, exchange, routing_key: str):
+        self.broker.bindings.append((routing_key, self))
+
+    async def consume(self, callback):
+        self.consumer = callback
+        return self.name
+
+    async def cancel(self, consumer_tag: str):
+        self.consumer = None
+
+
+class FakeExchange:
+    def __init__(self, broker: "FakeBroker", name: str):
+        self.broker = broker
+        self.name = name
+
+    async def publish(self, message, routing_key: str):
+        self.broker.published[routing_key] = self.broker.published.get(routing_key, 0) + 1
+        for pattern, queue in self.broker.bindings:
+            if queue.consumer is not None and topic_matches(pattern, routing_key):
+                await queue.consumer(FakeIncomingMessage(message, routing_key))
+
+
+class FakeChannel:
+    def __init__(self, broker: "FakeBroker"):
+        self.broker = broker
+
+    async def set_qos(self, prefetch_count: int):
+        pass
+
+    async def declare_exchange(self, name: str, **kwargs):
+        return self.broker.exchange(name)
+
+    async def declare_queue(self, name: str, **kwargs):
+        return self.broker.queue(name)
+
+
+class FakeBroker:
+    """
+        In-memory aio-pika connection: exchanges route published messages to the consumers of the bound
+        queues, and count them by routing key.
+    """
+
+    def __init__(self):
+        self.exchanges = {}
+        self.queues = {}
+        self.bindings = []
+        self.published = {}
+
+    def exchange(self, name: str) -> FakeExchange:
+        return self.exchanges.setdefault(name, FakeExchange(self, name))
+
+    def queue(self, name: str) -> FakeQueue:
+        return self.queues.setdefault(name, FakeQueue(self, name))
+
+    async def channel(self, publisher_confirms: bool = False):
+        return FakeChannel(self)
+
+    async def connect_robust(self, *args, **kwargs):
+        return self
+
+    async def deliver(self, queue_name: str, message) -> FakeIncomingMessage:
+        """
+            Hands a message straight to the consumer of a queue, returns it to await its `processed` future.
+        """
+        incoming_message = FakeIncomingMessage(message, queue_name)
+        await self.queues[queue_name].consumer(incoming_message)
+        return incoming_message
+
+
+def stub_decode_token(res, cred) -> dict:
+    """
+        Token verifier that trusts any bearer token, which is the user's e-mail.
+    """
+    if cred is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
+    return {"email": cred.credentials, "exp": time.time() + 3600}
+
+
+async def no_transactions() -> bool:
+    return False
+
+
+broker: Optional[FakeBroker] = None
+
+
+def install() -> FakeBroker:
+    """
+        Patches the clients of MongoDB, RabbitMQ and Firebase with the stand-ins. Must run before
+        PropertyService is imported. Returns the in-memory broker.
+    """
+    global broker
+    import firebase_admin
+    import motor.motor_asyncio
+    import pika
+    from mongomock_motor import AsyncMongoMockClient
+
+    motor.motor_asyncio.AsyncIOMotorClient = AsyncMongoMockClient
+    pika.BlockingConnection = StubBlockingConnection
+    firebase_admin.credentials.Certificate = lambda *args, **kwargs: None
+    firebase_admin.initialize_app = lambda *args, **kwargs: None
+
+    import PropertyService.dependencies
+    import PropertyService.messaging_operations
+    import PropertyService.outbox
+
+    broker = FakeBroker()
+    PropertyService.messaging_operations.connect_robust = broker.connect_robust
+    PropertyService.dependencies.decode_token = stub_decode_token
+    # the Mongo stand-in doesn't do transactions
+    PropertyService.outbox.supports_transactions = no_transactions
+    return broker
@@ -0,0 +1,236 @@
+"""
+    Load benchmark of PropertyService against in-process stand-ins for MongoDB, RabbitMQ and Firebase
+    (see benchmarks.fakes): drives the REST endpoints, property imports, recommended price responses and
+    both scheduled jobs with synthetic catalogs, and reports latency percentiles, throughput and peak memory.
+
+    python -m benchmarks.load [--sizes 1000 10000 100000] [--requests 1000] [--concurrency 32]
+
+    Needs the packages in benchmarks/requirements.txt.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import resource
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+from benchmarks import fakes
+
+broker = fakes.install()
+# the stand-in doesn't run aggregation pipelines like MongoDB does, analytics rows are shaped here
+os.environ.setdefault("ANALYTICS_EXPORT_MODE", "cursor")
+
+import httpx
+
+from benchmarks.data import make_property
+from ProjectUtils.MessagingService.queue_definitions import ANALYTICS_TO_PROPERTY_QUEUE_NAME
+from ProjectUtils.MessagingService.schemas import MessageType
+from PropertyService import database
+from PropertyService.cache import InMemoryCacheBackend, set_cache_backend
+from PropertyService.encoding import DecodedMessage, encode_message
+from PropertyService.features import materialized_features
+from PropertyService.main import app, price_recommendation, send_data_to_analytics
+from PropertyService.messaging_operations import import_properties, setup, stop_consumers
+from PropertyService.outbox import outbox_relay
+from PropertyService.schemas import Service
+
+# the service logs every message it handles, only its warnings and errors are kept
+for name in list(logging.root.manager.loggerDict):
+    if name.startswith("PropertyService"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+PROPERTIES_PER_USER = 50
+# properties per imported batch and per recommended prices message
+MESSAGE_SIZE = 100
+
+
+@dataclass
+class Result:
+    scenario: str
+    catalog: int
+    operations: int
+    p50: float
+    p99: float
+    throughput: float
+    peak_memory: float
+    errors: int
+
+
+def percentile(latencies: list[float], fraction: float) -> float:
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def peak_memory() -> float:
+    # high-water mark of the process' resident memory, in MB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def measure(scenario: str, catalog: int, operations: list, concurrency: int, items_per_operation: int = 1) -> Result:
+    """
+        Runs the operations (coroutine functions), up to `concurrency` at once, and times each of them.
+        Throughput counts `items_per_operation` items per operation.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def timed(operation):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            result = await operation()
+            latencies.append(time.perf_counter() - start)
+            if isinstance(result, httpx.Response) and result.is_error:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(timed(operation) for operation in operations))
+    elapsed = time.perf_counter() - start
+    return Result(
+        scenario, catalog, len(operations),
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+        len(operations) * items_per_operation / elapsed, peak_memory(), errors
+    )
+
+
+async def seed(size: int, rng: random.Random):
+    await database.client.drop_database(database.database.name)
+    set_cache_backend(InMemoryCacheBackend())
+    await database.ensure_indexes()
+    users = max(1, size // PROPERTIES_PER_USER)
+    now = datetime.now(timezone.utc)
+    # inserted in chunks, so that the whole catalog is never held twice
+    for start in range(1, size + 1, 10000):
+        documents = [
+            make_property(prop_id, f"owner{prop_id % users}@example.com", rng)
+            for prop_id in range(start, min(size, start + 9999) + 1)
+        ]
+        for document in documents:
+            document["features"] = materialized_features(document)
+            document["last_modified"] = now
+        await database.collection.insert_many(documents)
+
+
+def rest_scenarios(client: httpx.AsyncClient, size: int, requests: int, rng: random.Random) -> dict:
+    users = max(1, size // PROPERTIES_PER_USER)
+
+    def owned_property():
+        prop_id = rng.randint(1, size)
+        return prop_id, {"Authorization": f"Bearer owner{prop_id % users}@example.com"}
+
+    def get_properties():
+        _, headers = owned_property()
+        return lambda: client.get("/properties", params={"limit": 50}, headers=headers)
+
+    def get_property():
+        prop_id, headers = owned_property()
+        return lambda: client.get(f"/properties/{prop_id}", headers=headers)
+
+    def get_summaries():
+        _, headers = owned_property()
+        return lambda: client.get("/properties/summaries", params={"limit": 50, "fields": "title,price"}, headers=headers)
+
+    def put_property():
+        prop_id, headers = owned_property()
+        return lambda: client.put(f"/properties/{prop_id}", json={"price": float(rng.randint(30, 300))}, headers=headers)
+
+    def get_catalog():
+        _, headers = owned_property()
+        return lambda: client.get("/catalog", headers=headers)
+
+    return {
+        "GET /properties": [get_properties() for _ in range(requests)],
+        "GET /properties/{id}": [get_property() for _ in range(requests)],
+        "GET /properties/summaries": [get_summaries() for _ in range(requests)],
+        "PUT /properties/{id}": [put_property() for _ in range(requests)],
+        "GET /catalog": [get_catalog() for _ in range(requests)],
+    }
+
+
+def import_operations(size: int, batches: int, rng: random.Random) -> list:
+    def import_batch(batch):
+        first_id = size + batch * MESSAGE_SIZE + 1
+        properties = [
+            make_property(prop_id, f"importer{batch}@example.com", rng) for prop_id in range(first_id, first_id + MESSAGE_SIZE)
+        ]
+        for prop in properties:
+            prop.pop("services")
+        return lambda: import_properties(Service.ZOOKING.value, properties)
+
+    return [import_batch(batch) for batch in range(batches)]
+
+
+def recommended_price_operations(size: int, messages: int, rng: random.Random) -> list:
+    def deliver(message):
+        async def operation():
+            incoming_message = await broker.deliver(ANALYTICS_TO_PROPERTY_QUEUE_NAME, message)
+            await incoming_message.processed
+        return operation
+
+    operations = []
+    for _ in range(messages):
+        recommended_prices = {str(rng.randint(1, size)): float(rng.randint(30, 300)) for _ in range(MESSAGE_SIZE)}
+        operations.append(deliver(encode_message(
+            DecodedMessage(MessageType.RECOMMENDED_PRICE_RESPONSE, recommended_prices), encoding="msgpack"
+        )))
+    return operations
+
+
+async def run_job(scenario: str, size: int, job) -> Result:
+    # a job is one operation, its throughput counts the properties it went through
+    rows = {}
+
+    async def operation():
+        rows.update(await job() or {})
+
+    result = await measure(scenario, size, [operation], 1)
+    result.throughput *= rows.get("rows") or 0
+    return result
+
+
+async def benchmark(sizes: list[int], requests: int, concurrency: int) -> list[Result]:
+    rng = random.Random(0)
+    await setup(asyncio.get_running_loop())
+    await outbox_relay.start()
+    results = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://propertyservice") as client:
+        for size in sizes:
+            await seed(size, rng)
+            for scenario, operations in rest_scenarios(client, size, requests, rng).items():
+                results.append(await measure(scenario, size, operations, concurrency))
+            messages = max(1, requests // MESSAGE_SIZE)
+            results.append(await measure(
+                "import_properties", size, import_operations(size, messages, rng), concurrency, MESSAGE_SIZE
+            ))
+            results.append(await measure(
+                "consume_price_recomendation", size, recommended_price_operations(size, messages, rng), concurrency,
+                MESSAGE_SIZE
+            ))
+            results.append(await run_job("price_recommendation", size, price_recommendation))
+            results.append(await run_job("send_data_to_analytics", size, send_data_to_analytics))
+    await stop_consumers()
+    await outbox_relay.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="catalog sizes")
+    parser.add_argument("--requests", type=int, default=1000, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=32, help="requests in flight at once")
+    args = parser.parse_args()
+
+    results = asyncio.run(benchmark(args.sizes, args.requests, args.concurrency))
+    print(f"{'scenario':<28} {'catalog':>8} {'ops':>6} {'p50 (ms)':>9} {'p99 (ms)':>9} {'items/s':>10} {'peak RSS (MB)':>14} {'errors':>7}")
+    for result in results:
+        print(f"{result.scenario:<28} {result.catalog:>8} {result.operations:>6} {result.p50:>9.2f} {result.p99:>9.2f} "
+              f"{result.throughput:>10.1f} {result.peak_memory:>14.1f} {result.errors:>7}")
+
+
+if __name__ == "__main__":
+    main()